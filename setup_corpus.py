@@ -6,7 +6,6 @@ Fetches Breslov texts from Sefaria and creates embeddings
 
 import os
 import sys
-import json
 import argparse
 from pathlib import Path
 
@@ -14,7 +13,7 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent / "src"))
 
 from dotenv import load_dotenv
-from sefaria_fetcher import SefariaFetcher
+from sefaria_fetcher import SefariaFetcher, load_corpus
 from embeddings import EmbeddingsManager
 
 
@@ -34,13 +33,15 @@ def setup_corpus(api_key: str, force_refetch: bool = False):
     data_dir = Path(__file__).parent / "data"
     data_dir.mkdir(exist_ok=True)
 
-    corpus_path = data_dir / "breslov_corpus.json"
+    corpus_path = data_dir / "breslov_corpus.ndjson"
+    legacy_path = data_dir / "breslov_corpus.json"
+    if not force_refetch and not corpus_path.exists() and legacy_path.exists():
+        corpus_path = legacy_path
 
     # Step 1: Fetch corpus from Sefaria
     if corpus_path.exists() and not force_refetch:
         print(f"\n📚 Loading existing corpus from {corpus_path}")
-        with open(corpus_path, 'r', encoding='utf-8') as f:
-            corpus = json.load(f)
+        corpus = load_corpus(str(corpus_path))
         print(f"   Loaded {len(corpus)} documents")
     else:
         print("\n📥 Fetching Breslov corpus from Sefaria...")
@@ -13,16 +13,24 @@ CREATE TABLE IF NOT EXISTS breslov_documents (
     hebrew TEXT,
     english TEXT,
     combined TEXT,
-    embedding vector(3072),
+    embedding halfvec(3072),  -- float16: half the storage of vector(3072)
     chunk_index INTEGER DEFAULT 0,
     total_chunks INTEGER DEFAULT 1,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
--- 3. Create text search indices
--- Note: ivfflat index not used because Gemini embeddings are 3072 dimensions
--- (Supabase free tier limits ivfflat to 2000 dimensions)
--- Vector search will still work using sequential scan
+-- Existing tables created with vector(3072) can be converted in place:
+-- ALTER TABLE breslov_documents
+--     ALTER COLUMN embedding TYPE halfvec(3072) USING embedding::halfvec(3072);
+
+-- 3. Create vector and text search indices
+-- HNSW over halfvec (vector indexes are limited to 2000 dimensions,
+-- halfvec indexes to 4000, so Gemini's 3072 dimensions need halfvec)
+CREATE INDEX IF NOT EXISTS breslov_documents_embedding_idx
+ON breslov_documents
+USING hnsw (embedding halfvec_cosine_ops)
+WITH (m = 16, ef_construction = 64);
+
 CREATE INDEX IF NOT EXISTS breslov_documents_ref_idx
 ON breslov_documents(ref);
 
@@ -55,10 +63,10 @@ AS $$
         hebrew,
         english,
         combined,
-        1 - (embedding <=> query_embedding) AS similarity
+        1 - (embedding <=> query_embedding::halfvec(3072)) AS similarity
     FROM breslov_documents
-    WHERE 1 - (embedding <=> query_embedding) > match_threshold
-    ORDER BY embedding <=> query_embedding
+    WHERE 1 - (embedding <=> query_embedding::halfvec(3072)) > match_threshold
+    ORDER BY embedding <=> query_embedding::halfvec(3072)
     LIMIT match_count;
 $$;
 
@@ -88,11 +96,11 @@ AS $$
 
     -- Then: semantic matches (excluding already found refs)
     SELECT id, title, ref, combined,
-           1 - (embedding <=> query_embedding) as similarity,
+           1 - (embedding <=> query_embedding::halfvec(3072)) as similarity,
            'semantic' as match_type
     FROM breslov_documents
     WHERE LOWER(ref) != LOWER(search_ref)
-      AND 1 - (embedding <=> query_embedding) > match_threshold
+      AND 1 - (embedding <=> query_embedding::halfvec(3072)) > match_threshold
     ORDER BY similarity DESC
     LIMIT match_count;
 $$;
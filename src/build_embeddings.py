@@ -5,17 +5,23 @@ Creates FAISS index from semantically chunked documents
 
 import os
 import sys
-import json
 from dotenv import load_dotenv
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.embeddings import EmbeddingsManager
+from src.sefaria_fetcher import load_corpus
 
 
-def build_embeddings_from_chunks():
-    """Build embeddings from the chunked corpus"""
+def build_embeddings_from_chunks(index_type: str = "hnsw"):
+    """
+    Build embeddings from the chunked corpus
+
+    Besides the flat index, the ANN search index for `index_type`
+    ('hnsw' or 'ivf', 'flat' for none) is built and saved, so engines
+    created with that index type load it instead of building it.
+    """
 
     # Load environment
     load_dotenv("config/.env")
@@ -26,14 +32,20 @@ def build_embeddings_from_chunks():
         return
 
     # Load chunked corpus
-    chunked_path = "data/breslov_chunked.json"
+    chunked_path = "data/breslov_chunked.ndjson"
+    if not os.path.exists(chunked_path):
+        # Legacy JSON-array output of the chunker
+        chunked_path = "data/breslov_chunked.json"
     if not os.path.exists(chunked_path):
         print(f"Error: {chunked_path} not found. Run semantic_chunker.py first.")
         return
 
     print("Loading chunked corpus...")
-    with open(chunked_path, 'r', encoding='utf-8') as f:
-        chunks = json.load(f)
+    chunks = load_corpus(chunked_path)
+
+    if not chunks:
+        print(f"Error: {chunked_path} contains no chunks. Re-run semantic_chunker.py.")
+        return
 
     print(f"Loaded {len(chunks)} chunks")
 
@@ -50,7 +62,8 @@ def build_embeddings_from_chunks():
     manager = EmbeddingsManager(
         api_key=api_key,
         persist_dir="./data/faiss_db",
-        collection_name="breslov_chunked"  # New collection for chunked data
+        collection_name="breslov_chunked",  # New collection for chunked data
+        index_type=index_type
     )
 
     # Clear existing data
@@ -66,6 +79,8 @@ def build_embeddings_from_chunks():
     # Show stats
     stats = manager.get_collection_stats()
     print(f"\nFinal stats: {stats}")
+    if index_type != "flat":
+        print(f"Search index ({index_type}) saved to {manager.ann_index_path}")
 
     # Test search
     print("\n" + "="*60)
@@ -92,4 +107,4 @@ def build_embeddings_from_chunks():
 
 
 if __name__ == "__main__":
-    build_embeddings_from_chunks()
+    build_embeddings_from_chunks(os.getenv("EMBEDDINGS_INDEX_TYPE", "hnsw"))
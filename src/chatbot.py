@@ -6,7 +6,6 @@ Multi-language support (English, Hebrew, French) with TTS
 
 import os
 import sys
-import base64
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -418,7 +417,8 @@ def main():
                     response = st.session_state.engine.generate_response_with_audio(
                         prompt,
                         language=st.session_state.language,
-                        enable_tts=True
+                        enable_tts=True,
+                        encode_audio=False
                     )
                 else:
                     response = st.session_state.engine.generate_response(
@@ -432,8 +432,7 @@ def main():
 
             # Audio playback if TTS enabled
             if response.get("audio"):
-                audio_bytes = base64.b64decode(response["audio"])
-                st.audio(audio_bytes, format="audio/wav")
+                st.audio(response["audio"], format="audio/wav")
 
             # Show sources
             if response.get("sources") and len(response["sources"]) > 0:
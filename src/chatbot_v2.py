@@ -8,7 +8,6 @@ GUEZI Chatbot V2 - Complete Streamlit Interface
 
 import os
 import sys
-import base64
 import tempfile
 import streamlit as st
 from dotenv import load_dotenv
@@ -571,8 +570,7 @@ def main():
 
             # Audio playback
             if msg.get("audio"):
-                audio_bytes = base64.b64decode(msg["audio"])
-                st.audio(audio_bytes, format="audio/wav")
+                st.audio(msg["audio"], format="audio/wav")
 
             # Sources
             if msg.get("sources"):
@@ -635,13 +633,13 @@ def main():
             st.markdown(response["response"])
 
             # TTS
-            audio_b64 = None
+            audio_wav = None
             if st.session_state.enable_tts and response.get("response"):
                 with st.spinner("🔊 Generating audio..."):
                     voice = st.session_state.get('tts_voice', 'Kore')
                     audio_bytes = engine.text_to_speech(response["response"][:1200], voice=voice)
                     if audio_bytes:
-                        audio_b64 = base64.b64encode(audio_bytes).decode('utf-8')
+                        audio_wav = audio_bytes
                         st.audio(audio_bytes, format="audio/wav")
                     else:
                         st.caption("⚠️ Audio generation unavailable")
@@ -672,7 +670,7 @@ def main():
             "role": "assistant",
             "content": response["response"],
             "sources": response.get("sources", []),
-            "audio": audio_b64
+            "audio": audio_wav
         })
 
 
@@ -8,7 +8,6 @@ GUEZI Chatbot V3 - Voice-Enabled Edition
 
 import os
 import sys
-import base64
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -449,11 +448,7 @@ def main():
 
             # Audio playback
             if msg.get("audio"):
-                try:
-                    audio_bytes = base64.b64decode(msg["audio"])
-                    st.audio(audio_bytes, format="audio/wav")
-                except:
-                    pass
+                st.audio(msg["audio"], format="audio/wav")
 
             # Sources
             if msg.get("sources"):
@@ -500,7 +495,7 @@ def main():
             st.markdown(response["response"])
 
             # TTS
-            audio_b64 = None
+            audio_wav = None
             if st.session_state.enable_tts and response.get("response"):
                 with st.spinner("🔊 Generating audio..."):
                     voice = st.session_state.get('tts_voice', 'Kore')
@@ -508,7 +503,7 @@ def main():
                     tts_text = response["response"][:1500]
                     audio_bytes = engine.text_to_speech(tts_text, voice=voice)
                     if audio_bytes:
-                        audio_b64 = base64.b64encode(audio_bytes).decode('utf-8')
+                        audio_wav = audio_bytes
                         st.markdown('<div class="audio-player">', unsafe_allow_html=True)
                         st.audio(audio_bytes, format="audio/wav")
                         st.markdown('</div>', unsafe_allow_html=True)
@@ -533,7 +528,7 @@ def main():
             "role": "assistant",
             "content": response["response"],
             "sources": response.get("sources", []),
-            "audio": audio_b64
+            "audio": audio_wav
         })
 
 
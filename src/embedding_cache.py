@@ -0,0 +1,46 @@
+"""
+Embedding Cache
+On-disk cache of text embeddings keyed by SHA-256 of (model, text),
+so embeddings survive restarts and are shared between worker processes.
+"""
+
+import os
+import hashlib
+import tempfile
+from typing import List, Optional
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    One .npy file per embedding, stored as float16 (half the size of float32).
+
+    Writes go to a temporary file and are renamed into place, so concurrent
+    workers can write the same key safely.
+    """
+
+    def __init__(self, cache_dir: str = "./data/embed_cache", model: str = ""):
+        self.cache_dir = cache_dir
+        self.model = model
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, text: str) -> str:
+        key = hashlib.sha256(f"{self.model}\0{text}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, text: str) -> Optional[List[float]]:
+        """Cached embedding for a text, or None"""
+        try:
+            return np.load(self._path(text)).astype(np.float32).tolist()
+        except (OSError, ValueError):
+            return None
+
+    def put(self, text: str, embedding: List[float]):
+        """Store an embedding for a text"""
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(embedding, dtype=np.float16))
+            os.replace(tmp_path, self._path(text))
+        except OSError as e:
+            print(f"Embedding cache write error: {e}")
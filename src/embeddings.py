@@ -7,25 +7,70 @@ import os
 import json
 import pickle
 import time
-from typing import List, Dict, Optional
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional, Sequence
 import numpy as np
 import faiss
 from google import genai
 from tqdm import tqdm
 
+try:
+    from .embedding_cache import EmbeddingCache
+except ImportError:
+    from embedding_cache import EmbeddingCache
+
+# Length of the context preview sent to the LLM for each retrieved chunk
+CONTEXT_PREVIEW_CHARS = 1500
+
+EMBEDDING_MODEL = "gemini-embedding-001"
+
 
 class EmbeddingsManager:
     """Manage text embeddings with FAISS"""
 
+    # Quantized search precisions (the flat float32 index stays the source of truth).
+    # 'binary' keeps one sign bit per dimension and scans with Hamming distance.
+    QUANTIZED_PRECISIONS = {
+        'int8': faiss.ScalarQuantizer.QT_8bit,
+        'float16': faiss.ScalarQuantizer.QT_fp16,
+    }
+    BINARY_PRECISION = 'binary'
+
+    # Approximate (sublinear) search indexes, built from the flat index and persisted
+    ANN_INDEX_TYPES = ('hnsw', 'ivf')
+    HNSW_M = 32
+    HNSW_EF_CONSTRUCTION = 200
+    HNSW_EF_SEARCH = 64
+
+    # Candidates fetched from a quantized/ANN index, then re-ranked with exact float32 L2
+    RERANK_CANDIDATES = 100
+
+    # Number of query embeddings kept in the in-memory LRU cache
+    QUERY_CACHE_SIZE = 1024
+
     def __init__(
         self,
         api_key: str,
         persist_dir: str = "./data/faiss_db",
-        collection_name: str = "breslov_complete"
+        collection_name: str = "breslov_complete",
+        precision: str = "float32",
+        index_type: str = "flat",
+        embed_cache_dir: Optional[str] = None
     ):
+        if precision not in ("float32", self.BINARY_PRECISION) and precision not in self.QUANTIZED_PRECISIONS:
+            raise ValueError(f"Unsupported embeddings precision: {precision}")
+        if index_type != "flat" and index_type not in self.ANN_INDEX_TYPES:
+            raise ValueError(f"Unsupported index type: {index_type}")
+        if index_type != "flat" and precision != "float32":
+            raise ValueError("ANN index types require float32 precision")
+
         self.api_key = api_key
         self.persist_dir = persist_dir
         self.collection_name = collection_name
+        self.precision = precision
+        self.index_type = index_type
         self.embedding_dim = 3072  # Default for gemini-embedding-001
 
         # Initialize Gemini client for embeddings
@@ -37,11 +82,23 @@ class EmbeddingsManager:
         # Paths
         self.index_path = os.path.join(persist_dir, f"{collection_name}.index")
         self.metadata_path = os.path.join(persist_dir, f"{collection_name}_metadata.pkl")
+        self.ann_index_path = os.path.join(persist_dir, f"{collection_name}_{index_type}.index")
 
         # Load or create index
         self.index = None
+        self.search_index = None  # Index queried by search() (may be quantized/ANN)
         self.documents = []
         self.metadatas = []
+        self.text_previews = []
+        # Incremented whenever documents/metadatas change (for derived indexes)
+        self.version = 0
+
+        # LRU cache of single-text embeddings: sha256(model + query) -> vector
+        self._query_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        # Optional on-disk cache behind it, shared across restarts and workers.
+        # Opt-in: it is unbounded, so only enable it for a fixed query set.
+        self._disk_cache = EmbeddingCache(embed_cache_dir, EMBEDDING_MODEL) if embed_cache_dir else None
         self._load_or_create_index()
 
     def _load_or_create_index(self):
@@ -53,6 +110,9 @@ class EmbeddingsManager:
                     data = pickle.load(f)
                     self.documents = data.get('documents', [])
                     self.metadatas = data.get('metadatas', [])
+                self.text_previews = [d[:CONTEXT_PREVIEW_CHARS] for d in self.documents]
+                self.version += 1
+                self._build_search_index()
                 print(f"Loaded existing index with {self.index.ntotal} vectors")
             except Exception as e:
                 print(f"Error loading index: {e}")
@@ -63,8 +123,88 @@ class EmbeddingsManager:
     def _create_new_index(self):
         """Create a new FAISS index"""
         self.index = faiss.IndexFlatL2(self.embedding_dim)
+        self.search_index = self.index
         self.documents = []
         self.metadatas = []
+        self.text_previews = []
+        self.version += 1
+
+    def _build_search_index(self):
+        """
+        Build the index used for queries.
+
+        With a quantized precision, vectors are copied from the flat index into
+        a FAISS scalar-quantized index (int8: 4x less memory traffic per scan)
+        or, for 'binary', into a Hamming index of sign bits (32x less).
+        With an ANN index type, an HNSW/IVF index is loaded from disk (or
+        built and persisted) for sublinear search.
+        """
+        if self.index.ntotal == 0:
+            self.search_index = self.index
+            return
+
+        if self.index_type in self.ANN_INDEX_TYPES:
+            self.search_index = self._load_or_build_ann_index()
+            return
+
+        if self.precision == "float32":
+            self.search_index = self.index
+            return
+
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+
+        if self.precision == self.BINARY_PRECISION:
+            codes = np.packbits(vectors > 0, axis=1)
+            binary = faiss.IndexBinaryFlat(codes.shape[1] * 8)
+            binary.add(codes)
+            self.search_index = binary
+            return
+
+        quantized = faiss.IndexScalarQuantizer(
+            self.index.d,
+            self.QUANTIZED_PRECISIONS[self.precision],
+            faiss.METRIC_L2
+        )
+        quantized.train(vectors)
+        quantized.add(vectors)
+        self.search_index = quantized
+
+    def _load_or_build_ann_index(self):
+        """Load the persisted ANN index if it covers the flat index, else rebuild it"""
+        # Reuse the persisted index only if it is newer than the flat index
+        ann_fresh = os.path.exists(self.ann_index_path) and (
+            not os.path.exists(self.index_path)
+            or os.path.getmtime(self.ann_index_path) >= os.path.getmtime(self.index_path)
+        )
+        if ann_fresh:
+            try:
+                ann = faiss.read_index(self.ann_index_path)
+                if ann.ntotal == self.index.ntotal and ann.d == self.index.d:
+                    self._configure_ann_index(ann)
+                    return ann
+            except Exception as e:
+                print(f"Error loading {self.index_type} index: {e}")
+
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        if self.index_type == 'hnsw':
+            ann = faiss.IndexHNSWFlat(self.index.d, self.HNSW_M)
+            ann.hnsw.efConstruction = self.HNSW_EF_CONSTRUCTION
+        else:
+            nlist = max(1, int(np.sqrt(self.index.ntotal)))
+            ann = faiss.IndexIVFFlat(faiss.IndexFlatL2(self.index.d), self.index.d, nlist)
+            ann.train(vectors)
+        ann.add(vectors)
+        self._configure_ann_index(ann)
+
+        faiss.write_index(ann, self.ann_index_path)
+        return ann
+
+    def _configure_ann_index(self, ann):
+        """Set query-time search parameters of an ANN index"""
+        if self.index_type == 'hnsw':
+            ann.hnsw.efSearch = max(self.HNSW_EF_SEARCH, self.RERANK_CANDIDATES)
+        else:
+            ann.nprobe = max(1, ann.nlist // 4)
 
     def _save_index(self):
         """Save index and metadata to disk"""
@@ -76,16 +216,33 @@ class EmbeddingsManager:
             }, f)
 
     def get_embedding(self, text: str) -> List[float]:
-        """Get embedding for a single text"""
-        try:
-            result = self.client.models.embed_content(
-                model="gemini-embedding-001",
-                contents=text
-            )
-            return result.embeddings[0].values
-        except Exception as e:
-            print(f"Error getting embedding: {e}")
-            return []
+        """Get embedding for a single text (LRU-cached in memory, then on disk)"""
+        key = hashlib.sha256(f"{EMBEDDING_MODEL}\0{text}".encode('utf-8')).hexdigest()
+        with self._query_cache_lock:
+            cached = self._query_cache.get(key)
+            if cached is not None:
+                self._query_cache.move_to_end(key)
+                return cached
+
+        embedding = self._disk_cache.get(text) if self._disk_cache else None
+        if embedding is None:
+            try:
+                result = self.client.models.embed_content(
+                    model=EMBEDDING_MODEL,
+                    contents=text
+                )
+                embedding = result.embeddings[0].values
+            except Exception as e:
+                print(f"Error getting embedding: {e}")
+                return []
+            if self._disk_cache:
+                self._disk_cache.put(text, embedding)
+
+        with self._query_cache_lock:
+            self._query_cache[key] = embedding
+            if len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return embedding
 
     def get_embeddings_batch(self, texts: List[str], batch_size: int = 20) -> List[List[float]]:
         """Get embeddings for multiple texts in batches"""
@@ -95,7 +252,7 @@ class EmbeddingsManager:
             batch = texts[i:i + batch_size]
             try:
                 result = self.client.models.embed_content(
-                    model="gemini-embedding-001",
+                    model=EMBEDDING_MODEL,
                     contents=batch
                 )
                 batch_embeddings = [emb.values for emb in result.embeddings]
@@ -108,7 +265,7 @@ class EmbeddingsManager:
                 time.sleep(5)
                 try:
                     result = self.client.models.embed_content(
-                        model="gemini-embedding-001",
+                        model=EMBEDDING_MODEL,
                         contents=batch
                     )
                     batch_embeddings = [emb.values for emb in result.embeddings]
@@ -120,6 +277,42 @@ class EmbeddingsManager:
 
         return embeddings
 
+    def get_query_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Get embeddings for several queries, in order
+
+        Texts found in the memory or disk cache are not re-embedded; the
+        rest are embedded in a single batch call and cached.
+        """
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        missing = []
+
+        for i, text in enumerate(texts):
+            key = hashlib.sha256(f"{EMBEDDING_MODEL}\0{text}".encode('utf-8')).hexdigest()
+            with self._query_cache_lock:
+                results[i] = self._query_cache.get(key)
+            if results[i] is None and self._disk_cache:
+                results[i] = self._disk_cache.get(text)
+            if results[i] is None:
+                missing.append(i)
+
+        if missing:
+            batch = self.get_embeddings_batch([texts[i] for i in missing], batch_size=len(missing))
+            for i, embedding in zip(missing, batch):
+                results[i] = embedding
+                if embedding and self._disk_cache:
+                    self._disk_cache.put(texts[i], embedding)
+
+        with self._query_cache_lock:
+            for text, embedding in zip(texts, results):
+                if embedding:
+                    key = hashlib.sha256(f"{EMBEDDING_MODEL}\0{text}".encode('utf-8')).hexdigest()
+                    self._query_cache[key] = embedding
+            while len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+
+        return results
+
     def add_documents(self, documents: List[Dict], text_field: str = "combined"):
         """
         Add documents to the vector store
@@ -181,9 +374,13 @@ class EmbeddingsManager:
         # Store documents and metadata
         self.documents.extend(texts)
         self.metadatas.extend(metadatas)
+        self.text_previews.extend(t[:CONTEXT_PREVIEW_CHARS] for t in texts)
+        self.version += 1
 
-        # Save to disk
+        # Save to disk (before building the search index, so a persisted ANN
+        # index is newer than the flat index and is reused on the next load)
         self._save_index()
+        self._build_search_index()
 
         print(f"Successfully added {len(texts)} documents. Total: {self.index.ntotal}")
 
@@ -191,7 +388,9 @@ class EmbeddingsManager:
         self,
         query: str,
         n_results: int = 5,
-        filter_metadata: Optional[Dict] = None
+        filter_metadata: Optional[Dict] = None,
+        query_embedding: Optional[List[float]] = None,
+        subset: Optional[Sequence[int]] = None
     ) -> List[Dict]:
         """
         Search for similar documents
@@ -200,6 +399,8 @@ class EmbeddingsManager:
             query: Search query
             n_results: Number of results to return
             filter_metadata: Optional metadata filter (not implemented for FAISS)
+            query_embedding: Precomputed query embedding (skips the embedding call)
+            subset: Restrict the search to these document indices (e.g. one book)
 
         Returns:
             List of relevant documents with scores
@@ -208,17 +409,61 @@ class EmbeddingsManager:
             return []
 
         # Get query embedding
-        query_embedding = self.get_embedding(query)
-        if not query_embedding:
+        if query_embedding is None:
+            query_embedding = self.get_embedding(query)
+        if not len(query_embedding):
             return []
 
         # Search
         query_array = np.array([query_embedding]).astype('float32')
-        distances, indices = self.index.search(query_array, min(n_results, self.index.ntotal))
+        if subset is not None:
+            distances, indices = self._search_subset(query_array, n_results, subset)
+        else:
+            distances, indices = self._search_vectors(query_array, min(n_results, self.index.ntotal))
+
+        return self._format_results(indices[0], distances[0])
+
+    def search_batch(
+        self,
+        queries: List[str],
+        n_results: int = 5,
+        query_embeddings: Optional[List[List[float]]] = None
+    ) -> List[List[Dict]]:
+        """
+        Search for several queries at once
+
+        All queries go through one index search call (FAISS parallelizes
+        over queries), instead of one call per query.
+
+        Args:
+            queries: Search queries
+            n_results: Number of results per query
+            query_embeddings: Precomputed query embeddings (skips the embedding calls)
 
-        # Format results
+        Returns:
+            One result list per query, in order (see search)
+        """
+        if self.index.ntotal == 0 or not queries:
+            return [[] for _ in queries]
+
+        if query_embeddings is None:
+            query_embeddings = self.get_query_embeddings(queries)
+
+        rows = [i for i, emb in enumerate(query_embeddings) if len(emb)]
+        results: List[List[Dict]] = [[] for _ in queries]
+        if not rows:
+            return results
+
+        query_array = np.array([query_embeddings[i] for i in rows]).astype('float32')
+        distances, indices = self._search_vectors(query_array, min(n_results, self.index.ntotal))
+        for row, idx_row, dist_row in zip(rows, indices, distances):
+            results[row] = self._format_results(idx_row, dist_row)
+        return results
+
+    def _format_results(self, indices, distances) -> List[Dict]:
+        """Result dicts for one query's (indices, distances) row"""
         documents = []
-        for i, (idx, distance) in enumerate(zip(indices[0], distances[0])):
+        for idx, distance in zip(indices, distances):
             if idx < 0 or idx >= len(self.documents):
                 continue
 
@@ -228,6 +473,7 @@ class EmbeddingsManager:
             doc = {
                 'id': f"doc_{idx}",
                 'text': self.documents[idx],
+                'text_preview_1500': self.text_previews[idx],
                 'metadata': self.metadatas[idx],
                 'distance': float(distance),
                 'relevance_score': relevance
@@ -236,13 +482,71 @@ class EmbeddingsManager:
 
         return documents
 
+    def _search_vectors(self, query_array: np.ndarray, k: int):
+        """
+        Top-k (distances, indices) rows for (n, d) queries, FAISS-style.
+
+        Quantized and ANN indexes only shortlist RERANK_CANDIDATES vectors
+        per query; each shortlist is re-ranked with exact float32 L2 distances.
+        """
+        if self.search_index is self.index:
+            return self.index.search(query_array, k)
+
+        n_candidates = min(max(k, self.RERANK_CANDIDATES), self.index.ntotal)
+        if self.precision == self.BINARY_PRECISION:
+            _, candidates = self.search_index.search(np.packbits(query_array > 0, axis=1), n_candidates)
+        else:
+            _, candidates = self.search_index.search(query_array, n_candidates)
+
+        distances, indices = [], []
+        for query, row in zip(query_array, candidates):
+            row = row[row >= 0]
+            exact = ((self.get_vectors(row.tolist()) - query) ** 2).sum(axis=1)
+            order = np.argsort(exact)[:k]
+            distances.append(exact[order])
+            indices.append(row[order])
+        return distances, indices
+
+    def _search_subset(self, query_array: np.ndarray, k: int, subset: Sequence[int]):
+        """
+        Exact top-k (distances, indices) among a subset of documents
+
+        The flat index is searched in place with an ID selector, so the
+        subset's vectors are never copied out of FAISS.
+        """
+        subset = np.asarray(subset, dtype=np.int64)
+        if not len(subset):
+            return np.empty((1, 0), dtype=np.float32), np.empty((1, 0), dtype=np.int64)
+
+        k = min(k, len(subset))
+        if hasattr(faiss, 'SearchParameters'):
+            # faiss >= 1.7.3; the selector must outlive the search call
+            selector = faiss.IDSelectorBatch(subset)
+            return self.index.search(query_array, k, params=faiss.SearchParameters(sel=selector))
+
+        distances = ((self.get_vectors(subset) - query_array) ** 2).sum(axis=1)
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return distances[top][None, :], subset[top][None, :]
+
+    def get_vectors(self, indices: List[int]) -> np.ndarray:
+        """Get the stored float32 vectors for document indices as an (n, d) matrix"""
+        if not len(indices):
+            return np.empty((0, self.index.d), dtype=np.float32)
+        # One call into FAISS for the whole batch (faiss >= 1.7.3)
+        if hasattr(self.index, 'reconstruct_batch'):
+            return self.index.reconstruct_batch(np.asarray(indices, dtype=np.int64))
+        return np.vstack([self.index.reconstruct(int(i)) for i in indices])
+
     def get_collection_stats(self) -> Dict:
         """Get statistics about the collection"""
         return {
             'name': self.collection_name,
             'count': self.index.ntotal if self.index else 0,
             'persist_dir': self.persist_dir,
-            'embedding_dim': self.embedding_dim
+            'embedding_dim': self.embedding_dim,
+            'precision': self.precision,
+            'index_type': self.index_type
         }
 
     def clear_collection(self):
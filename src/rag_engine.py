@@ -5,8 +5,20 @@ Multi-language support (English, Hebrew, French) with TTS
 """
 
 import os
+import io
+import re
 import base64
-from typing import List, Dict, Optional, Literal
+import struct
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from types import MappingProxyType
+from itertools import islice
+from typing import List, Dict, Optional, Literal, Deque, Tuple, AsyncIterator, Sequence, Union
 from google import genai
 from google.genai import types
 
@@ -38,6 +50,21 @@ LANGUAGE_CONFIGS = {
 }
 
 
+@dataclass(frozen=True, slots=True)
+class LangCfg:
+    """Typed, immutable language configuration"""
+    name: str
+    instruction: str
+    tts_voice: str = 'Kore'
+    greeting: str = ''
+
+
+# Attribute-access view of LANGUAGE_CONFIGS, built once at import
+LANGUAGE_CONFIGS_TYPED = MappingProxyType({
+    lang: LangCfg(**cfg) for lang, cfg in LANGUAGE_CONFIGS.items()
+})
+
+
 class GUEZIRagEngine:
     """
     RAG Engine for Rabbi Nachman/Breslov texts
@@ -66,12 +93,34 @@ Guidelines:
 
 You have access to retrieved passages from authentic Breslov texts. Use ONLY these passages to ground your responses."""
 
+    # Only the last few messages are sent to the model; keep a bounded history
+    HISTORY_MAXLEN = 16
+
+    TTS_MODEL = "gemini-2.5-flash-preview-tts"
+    # TTS requests in flight at once (keeps within the TTS rate limit)
+    TTS_MAX_CONCURRENT = 4
+    # Sentences are grouped into TTS requests of about this many characters
+    TTS_CHUNK_CHARS = 400
+
+    # Sentence boundaries used to hand streamed text to TTS
+    _SENTENCE_END_RE = re.compile(r'(?<=[.!?;׃])\s+')
+
     def __init__(
         self,
         api_key: str,
         model: str = "gemini-2.0-flash",
-        embeddings_manager: Optional[EmbeddingsManager] = None
+        embeddings_manager: Optional[EmbeddingsManager] = None,
+        response_cache_path: Optional[str] = None
     ):
+        """
+        Args:
+            api_key: Gemini API key
+            model: Chat model name
+            embeddings_manager: Existing embeddings manager to reuse
+            response_cache_path: SQLite file for cached responses, e.g.
+                ".cache/guezi_llm.sqlite" (opt-in: identical prompts then replay
+                the stored answer, even when sampled with temperature > 0)
+        """
         self.api_key = api_key
         self.model = model
 
@@ -87,39 +136,99 @@ You have access to retrieved passages from authentic Breslov texts. Use ONLY the
         # Initialize Sefaria fetcher for real-time lookups
         self.sefaria = SefariaFetcher()
 
-        # Chat history for context
-        self.chat_history: List[Dict] = []
+        # Chat history for context (ring buffer)
+        self.chat_history: Deque[Dict] = deque(maxlen=self.HISTORY_MAXLEN)
+
+        # Optional persistent response cache keyed by (prompt, model, temperature)
+        self._response_cache: Optional[sqlite3.Connection] = None
+        self._response_cache_lock = threading.Lock()
+        if response_cache_path:
+            self._response_cache = self._open_response_cache(response_cache_path)
+
+    def _open_response_cache(self, path: str) -> Optional[sqlite3.Connection]:
+        """Open (or create) the SQLite response cache"""
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response BLOB)"
+            )
+            conn.commit()
+            return conn
+        except sqlite3.Error as e:
+            print(f"Response cache disabled: {e}")
+            return None
+
+    def _response_cache_key(self, full_prompt: str, temperature: float) -> Optional[str]:
+        """Cache key for a prompt, or None when the response should not be cached"""
+        if self._response_cache is None:
+            return None
+        digest = hashlib.sha256(full_prompt.encode('utf-8')).hexdigest()
+        return f"{digest}:{self.model}:{temperature:.2f}"
+
+    def _cached_response(self, key: Optional[str]) -> Optional[str]:
+        """Look up a cached response text"""
+        if key is None:
+            return None
+        with self._response_cache_lock:
+            row = self._response_cache.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0].decode('utf-8') if row else None
+
+    def _store_response(self, key: Optional[str], response_text: str):
+        """Persist a response text under its cache key"""
+        if key is None or not response_text:
+            return
+        with self._response_cache_lock:
+            self._response_cache.execute(
+                "INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)",
+                (key, response_text.encode('utf-8'))
+            )
+            self._response_cache.commit()
 
-    def retrieve_context(self, query: str, n_results: int = 5) -> str:
+    def retrieve_context(
+        self,
+        query: str,
+        n_results: int = 5,
+        query_embedding: Optional[List[float]] = None
+    ) -> str:
         """
         Retrieve relevant context from vector store
 
         Args:
             query: User's question
             n_results: Number of passages to retrieve
+            query_embedding: Precomputed query embedding
 
         Returns:
             Formatted context string
         """
-        results = self.embeddings.search(query, n_results=n_results)
+        results = self.embeddings.search(
+            query,
+            n_results=n_results,
+            query_embedding=query_embedding
+        )
+        return self._format_context(results)
 
+    def _format_context(self, results: List[Dict]) -> str:
+        """Format search results as the prompt's context block"""
         if not results:
             return ""
 
-        context_parts = []
-        for i, doc in enumerate(results, 1):
-            ref = doc['metadata'].get('ref', 'Unknown')
-            title = doc['metadata'].get('title', '')
-
-            # For chunked documents, the full text is in 'text' field
-            text_content = doc.get('text', '')
+        context_parts = [None] * len(results)
+        for i, doc in enumerate(results):
+            metadata = doc['metadata']
+            # For chunked documents, the full text is in 'text' field;
+            # the store precomputes its first 1500 chars
+            preview = doc.get('text_preview_1500')
+            if preview is None:
+                preview = doc.get('text', '')[:1500]
 
-            part = f"[Source {i}: {title} - {ref}]\n"
-            # Use the full text from the chunk (up to 1500 chars for good context)
-            if text_content:
-                part += f"Content: {text_content[:1500]}\n"
-
-            context_parts.append(part)
+            source = f"[Source {i + 1}: {metadata.get('title', '')} - {metadata.get('ref', 'Unknown')}]"
+            context_parts[i] = f"{source}\nContent: {preview}\n" if preview else f"{source}\n"
 
         return "\n---\n".join(context_parts)
 
@@ -128,7 +237,8 @@ You have access to retrieved passages from authentic Breslov texts. Use ONLY the
         user_message: str,
         use_rag: bool = True,
         temperature: float = 0.7,
-        language: str = 'en'
+        language: str = 'en',
+        history: Optional[Deque[Dict]] = None
     ) -> Dict:
         """
         Generate a response using RAG
@@ -138,84 +248,179 @@ You have access to retrieved passages from authentic Breslov texts. Use ONLY the
             use_rag: Whether to use RAG (retrieve context)
             temperature: Generation temperature
             language: Response language ('en', 'he', 'fr')
+            history: Conversation history to read and update
+                (defaults to the engine's own chat_history)
 
         Returns:
             Dict with response, sources, and metadata
         """
-        # Retrieve relevant context
-        context = ""
-        sources = []
-        if use_rag:
-            context = self.retrieve_context(user_message, n_results=7)  # More context for better answers
-            sources = self.embeddings.search(user_message, n_results=5)
+        if history is None:
+            history = self.chat_history
 
-        # Get language configuration
-        lang_config = LANGUAGE_CONFIGS.get(language, LANGUAGE_CONFIGS['en'])
+        full_prompt, context, sources = self._build_prompt(
+            user_message, use_rag, language, history
+        )
 
-        # Build the prompt
-        prompt_parts = [self.SYSTEM_PROMPT]
+        # Generate response (or replay an identical earlier one)
+        try:
+            cache_key = self._response_cache_key(full_prompt, temperature)
+            response_text = self._cached_response(cache_key)
+            if response_text is None:
+                response = self.client.models.generate_content(
+                    model=self.model,
+                    contents=full_prompt,
+                    config=self._generation_config(temperature)
+                )
 
-        # Add language instruction
-        prompt_parts.append(f"\n\nIMPORTANT: {lang_config['instruction']}")
+                response_text = response.text
+                self._store_response(cache_key, response_text)
 
-        if context:
-            prompt_parts.append(f"\n\nRelevant passages from Breslov texts (USE ONLY THESE SOURCES):\n{context}")
-        else:
-            prompt_parts.append("\n\nNote: No relevant passages were found. Please inform the user that you don't have information on this topic.")
+            # Update chat history
+            history.append({'role': 'user', 'content': user_message})
+            history.append({'role': 'assistant', 'content': response_text})
 
-        # Add chat history for context
-        if self.chat_history:
-            history_text = "\n\nPrevious conversation:\n"
-            for msg in self.chat_history[-6:]:  # Last 3 exchanges
-                role = "User" if msg['role'] == 'user' else "GUEZI"
-                history_text += f"{role}: {msg['content'][:500]}\n"
-            prompt_parts.append(history_text)
+            return self._format_result(response_text, sources, context, use_rag, language)
+
+        except Exception as e:
+            return self._error_result(e)
+
+    async def agenerate_response(
+        self,
+        user_message: str,
+        use_rag: bool = True,
+        temperature: float = 0.7,
+        language: str = 'en',
+        history: Optional[Deque[Dict]] = None
+    ) -> Dict:
+        """
+        Async variant of generate_response
 
-        prompt_parts.append(f"\n\nUser's question: {user_message}\n\nGUEZI's response:")
+        Retrieval (embedding + vector search) runs in a worker thread and the
+        generation call uses the async Gemini client, so many conversations
+        can be served concurrently from one event loop.
+        """
+        if history is None:
+            history = self.chat_history
 
-        full_prompt = "\n".join(prompt_parts)
+        full_prompt, context, sources = await asyncio.to_thread(
+            self._build_prompt, user_message, use_rag, language, history
+        )
 
-        # Generate response
         try:
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=full_prompt,
-                config=types.GenerateContentConfig(
-                    temperature=temperature,
-                    max_output_tokens=2048,
-                    top_p=0.9,
+            # SQLite calls block, so they run off the event loop
+            cache_key = self._response_cache_key(full_prompt, temperature)
+            response_text = None
+            if cache_key is not None:
+                response_text = await asyncio.to_thread(self._cached_response, cache_key)
+            if response_text is None:
+                response = await self.client.aio.models.generate_content(
+                    model=self.model,
+                    contents=full_prompt,
+                    config=self._generation_config(temperature)
                 )
-            )
 
-            response_text = response.text
+                response_text = response.text
+                if cache_key is not None:
+                    await asyncio.to_thread(self._store_response, cache_key, response_text)
 
             # Update chat history
-            self.chat_history.append({'role': 'user', 'content': user_message})
-            self.chat_history.append({'role': 'assistant', 'content': response_text})
-
-            return {
-                'response': response_text,
-                'sources': [
-                    {
-                        'title': s['metadata'].get('title', ''),
-                        'ref': s['metadata'].get('ref', ''),
-                        'relevance': s.get('relevance_score', 0)
-                    }
-                    for s in sources
-                ],
-                'model': self.model,
-                'used_rag': use_rag and bool(context),
-                'language': language,
-                'context_chunks': len(sources)
-            }
+            history.append({'role': 'user', 'content': user_message})
+            history.append({'role': 'assistant', 'content': response_text})
+
+            return self._format_result(response_text, sources, context, use_rag, language)
 
         except Exception as e:
-            return {
-                'response': f"I apologize, but I encountered an error: {str(e)}. Please try again.",
-                'sources': [],
-                'model': self.model,
-                'error': str(e)
-            }
+            return self._error_result(e)
+
+    def _build_prompt(
+        self,
+        user_message: str,
+        use_rag: bool,
+        language: str,
+        history: Deque[Dict]
+    ) -> Tuple[str, str, List[Dict]]:
+        """Retrieve context and assemble the full prompt; returns (prompt, context, sources)"""
+        # Retrieve relevant context
+        context = ""
+        sources = []
+        if use_rag:
+            # One search serves both the context and the reported sources
+            # (repeated queries hit the embeddings manager's LRU cache)
+            results = self.embeddings.search(
+                user_message,
+                n_results=7  # More context for better answers
+            )
+            context = self._format_context(results)
+            sources = results[:5]
+
+        # Build the prompt in a single buffer,
+        # starting with the precomputed (byte-identical) prefix
+        buf = io.StringIO()
+        buf.write(PRECOMPUTED_PREFIXES.get(language) or PRECOMPUTED_PREFIXES['en'])
+
+        if context:
+            buf.write("\n\n\nRelevant passages from Breslov texts (USE ONLY THESE SOURCES):\n")
+            buf.write(context)
+        else:
+            buf.write("\n\n\nNote: No relevant passages were found. Please inform the user that you don't have information on this topic.")
+
+        # Add chat history for context
+        if history:
+            buf.write("\n\n\nPrevious conversation:\n")
+            # Last 3 exchanges
+            for msg in islice(history, max(len(history) - 6, 0), None):
+                buf.write("User" if msg['role'] == 'user' else "GUEZI")
+                buf.write(": ")
+                buf.write(msg['content'][:500])
+                buf.write("\n")
+
+        buf.write("\n\n\nUser's question: ")
+        buf.write(user_message)
+        buf.write("\n\nGUEZI's response:")
+
+        return buf.getvalue(), context, sources
+
+    def _generation_config(self, temperature: float) -> types.GenerateContentConfig:
+        """Generation settings shared by the sync and streaming paths"""
+        return types.GenerateContentConfig(
+            temperature=temperature,
+            max_output_tokens=2048,
+            top_p=0.9,
+        )
+
+    def _format_result(
+        self,
+        response_text: str,
+        sources: List[Dict],
+        context: str,
+        use_rag: bool,
+        language: str
+    ) -> Dict:
+        """Shape a generated answer into the response dict"""
+        return {
+            'response': response_text,
+            'sources': [
+                {
+                    'title': s['metadata'].get('title', ''),
+                    'ref': s['metadata'].get('ref', ''),
+                    'relevance': s.get('relevance_score', 0)
+                }
+                for s in sources
+            ],
+            'model': self.model,
+            'used_rag': use_rag and bool(context),
+            'language': language,
+            'context_chunks': len(sources)
+        }
+
+    def _error_result(self, e: Exception) -> Dict:
+        """Response dict for a failed generation"""
+        return {
+            'response': f"I apologize, but I encountered an error: {str(e)}. Please try again.",
+            'sources': [],
+            'model': self.model,
+            'error': str(e)
+        }
 
     def lookup_reference(self, ref: str) -> Dict:
         """
@@ -243,18 +448,9 @@ You have access to retrieved passages from authentic Breslov texts. Use ONLY the
         try:
             # Use Gemini 2.5 Flash TTS
             response = self.client.models.generate_content(
-                model="gemini-2.5-flash-preview-tts",
+                model=self.TTS_MODEL,
                 contents=text,
-                config=types.GenerateContentConfig(
-                    response_modalities=["AUDIO"],
-                    speech_config=types.SpeechConfig(
-                        voice_config=types.VoiceConfig(
-                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                voice_name=voice
-                            )
-                        )
-                    )
-                )
+                config=self._tts_config(voice)
             )
 
             # Extract audio data
@@ -268,42 +464,286 @@ You have access to retrieved passages from authentic Breslov texts. Use ONLY the
             print(f"TTS error: {e}")
             return None
 
+    def _tts_config(self, voice: str) -> types.GenerateContentConfig:
+        """TTS request settings"""
+        return types.GenerateContentConfig(
+            response_modalities=["AUDIO"],
+            speech_config=types.SpeechConfig(
+                voice_config=types.VoiceConfig(
+                    prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                        voice_name=voice
+                    )
+                )
+            )
+        )
+
+    @staticmethod
+    def _audio_data(response) -> Optional[bytes]:
+        """Inline audio of a TTS response, if any"""
+        if response.candidates and response.candidates[0].content.parts:
+            audio_part = response.candidates[0].content.parts[0]
+            if hasattr(audio_part, 'inline_data') and audio_part.inline_data:
+                return audio_part.inline_data.data
+        return None
+
+    def _group_for_tts(self, chunk: str, sentences: Sequence[str]) -> Tuple[List[str], str]:
+        """
+        Add completed sentences to the open TTS chunk
+
+        Returns (chunks of about TTS_CHUNK_CHARS ready for TTS, new open chunk).
+        """
+        ready = []
+        for sentence in sentences:
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            if chunk and len(chunk) + len(sentence) + 1 > self.TTS_CHUNK_CHARS:
+                ready.append(chunk)
+                chunk = sentence
+            else:
+                chunk = f"{chunk} {sentence}" if chunk else sentence
+        return ready, chunk
+
+    def _tts_pcm(self, text: str, voice: str) -> Optional[bytes]:
+        """Synthesize one chunk, returning raw PCM (24kHz, mono, 16-bit); never raises"""
+        try:
+            return self._audio_data(self.client.models.generate_content(
+                model=self.TTS_MODEL,
+                contents=text,
+                config=self._tts_config(voice)
+            ))
+        except Exception as e:
+            print(f"TTS error: {e}")
+            return None
+
+    async def _tts_one(self, text: str, voice: str, semaphore: asyncio.Semaphore) -> Optional[bytes]:
+        """Async _tts_pcm, at most TTS_MAX_CONCURRENT at a time through `semaphore`"""
+        try:
+            async with semaphore:
+                response = await self.client.aio.models.generate_content(
+                    model=self.TTS_MODEL,
+                    contents=text,
+                    config=self._tts_config(voice)
+                )
+            return self._audio_data(response)
+        except Exception as e:
+            print(f"TTS error: {e}")
+            return None
+
+    @staticmethod
+    def _pcm_to_wav(pcm_data: Union[bytes, Sequence[bytes]], sample_rate: int = 24000, channels: int = 1, bits_per_sample: int = 16) -> bytes:
+        """
+        Wrap raw PCM audio in a single WAV header
+
+        pcm_data may be a list of PCM chunks; they are written straight after
+        the header in one allocation, without joining them first.
+        """
+        chunks = (pcm_data,) if isinstance(pcm_data, (bytes, bytearray, memoryview)) else pcm_data
+        byte_rate = sample_rate * channels * bits_per_sample // 8
+        block_align = channels * bits_per_sample // 8
+        data_size = sum(len(chunk) for chunk in chunks)
+        return b''.join((
+            struct.pack(
+                '<4sI4s4sIHHIIHH4sI',
+                b'RIFF', 36 + data_size, b'WAVE',
+                b'fmt ', 16, 1, channels, sample_rate, byte_rate, block_align, bits_per_sample,
+                b'data', data_size
+            ),
+            *chunks
+        ))
+
+    async def astream_response_with_audio(
+        self,
+        user_message: str,
+        language: str = 'en',
+        enable_tts: bool = True,
+        temperature: float = 0.7,
+        history: Optional[Deque[Dict]] = None,
+        encode_audio: bool = True
+    ) -> AsyncIterator[Dict]:
+        """
+        Stream a response, synthesizing completed text while the rest is generated
+
+        Sentences are grouped into chunks of about TTS_CHUNK_CHARS characters,
+        one TTS request per chunk.
+
+        Yields events in order:
+            {'type': 'text', 'text': ...}    generated text as it arrives
+            {'type': 'audio', 'audio': ...}  raw PCM per chunk, in text order
+            {'type': 'done', 'result': ...}  final response dict (as generate_response_with_audio)
+
+        If a chunk fails to synthesize, no further audio is yielded and the
+        final result has no audio. With encode_audio=False the final 'audio'
+        is raw WAV bytes instead of base64.
+        """
+        if history is None:
+            history = self.chat_history
+
+        full_prompt, context, sources = await asyncio.to_thread(
+            self._build_prompt, user_message, True, language, history
+        )
+        voice = (LANGUAGE_CONFIGS_TYPED.get(language) or LANGUAGE_CONFIGS_TYPED['en']).tts_voice
+
+        text_parts = []
+        tts_tasks = []
+        pcm_parts = []
+        pending = ""
+        tts_chunk = ""
+        semaphore = asyncio.Semaphore(self.TTS_MAX_CONCURRENT)
+
+        def start_tts(chunks: List[str]):
+            if enable_tts:
+                tts_tasks.extend(asyncio.create_task(self._tts_one(chunk, voice, semaphore)) for chunk in chunks)
+
+        try:
+            stream = await self.client.aio.models.generate_content_stream(
+                model=self.model,
+                contents=full_prompt,
+                config=self._generation_config(temperature)
+            )
+            async for chunk in stream:
+                delta = chunk.text or ""
+                if not delta:
+                    continue
+                text_parts.append(delta)
+                yield {'type': 'text', 'text': delta}
+
+                # Hand completed sentences to TTS once a full chunk is ready
+                *sentences, pending = self._SENTENCE_END_RE.split(pending + delta)
+                ready, tts_chunk = self._group_for_tts(tts_chunk, sentences)
+                start_tts(ready)
+
+                # Emit audio that is already ready, keeping text order
+                while len(pcm_parts) < len(tts_tasks) and tts_tasks[len(pcm_parts)].done():
+                    pcm = tts_tasks[len(pcm_parts)].result()
+                    pcm_parts.append(pcm)
+                    if all(pcm_parts):
+                        yield {'type': 'audio', 'audio': pcm}
+            ready, tts_chunk = self._group_for_tts(tts_chunk, [pending])
+            start_tts(ready + [tts_chunk] if tts_chunk else ready)
+
+        except Exception as e:
+            for task in tts_tasks:
+                task.cancel()
+            yield {'type': 'done', 'result': self._error_result(e)}
+            return
+
+        # _tts_one never raises: a failed chunk drops the audio, not the text
+        for task in tts_tasks[len(pcm_parts):]:
+            pcm = await task
+            pcm_parts.append(pcm)
+            if all(pcm_parts):
+                yield {'type': 'audio', 'audio': pcm}
+
+        yield {'type': 'done', 'result': self._audio_result(
+            user_message, text_parts, pcm_parts, sources, context, language, history, encode_audio
+        )}
+
+    def _audio_result(
+        self,
+        user_message: str,
+        text_parts: List[str],
+        pcm_parts: List[Optional[bytes]],
+        sources: List[Dict],
+        context: str,
+        language: str,
+        history: Deque[Dict],
+        encode_audio: bool
+    ) -> Dict:
+        """Record the turn in history and shape the response dict with its audio"""
+        response_text = "".join(text_parts)
+        history.append({'role': 'user', 'content': user_message})
+        history.append({'role': 'assistant', 'content': response_text})
+
+        result = self._format_result(response_text, sources, context, True, language)
+        if not all(pcm_parts):
+            # Like the V2 engine: no audio rather than audio with silent gaps
+            print("TTS: No audio data in response")
+        elif pcm_parts:
+            # The WAV is never bound to a local: only the encoded form (or the
+            # raw bytes, for callers that encode at their own I/O layer) is kept
+            if encode_audio:
+                result['audio'] = base64.b64encode(self._pcm_to_wav(pcm_parts)).decode('ascii')
+            else:
+                result['audio'] = self._pcm_to_wav(pcm_parts)
+            result['audio_format'] = 'wav'
+        return result
+
     def generate_response_with_audio(
         self,
         user_message: str,
         language: str = 'en',
-        enable_tts: bool = True
+        enable_tts: bool = True,
+        encode_audio: bool = True
     ) -> Dict:
         """
         Generate response with optional TTS audio
 
+        Generation is streamed and completed sentences are synthesized in
+        chunks of about TTS_CHUNK_CHARS characters (in worker threads, at
+        most TTS_MAX_CONCURRENT at a time),
+        so TTS overlaps with the rest of the generation. No event loop is
+        used, so this is safe to call from any thread.
+
         Args:
             user_message: User's question
             language: Response language
             enable_tts: Whether to generate audio
+            encode_audio: Return audio as base64 text (False: raw WAV bytes,
+                for servers that stream or encode at the serializer layer)
 
         Returns:
             Dict with response, sources, and optional audio
         """
-        # Get text response
-        result = self.generate_response(user_message, language=language)
-
-        # Generate audio if enabled
-        if enable_tts and result.get('response'):
-            lang_config = LANGUAGE_CONFIGS.get(language, LANGUAGE_CONFIGS['en'])
-            audio = self.text_to_speech(
-                result['response'],
-                voice=lang_config.get('tts_voice', 'Kore')
-            )
-            if audio:
-                result['audio'] = base64.b64encode(audio).decode('utf-8')
-                result['audio_format'] = 'wav'
-
-        return result
+        history = self.chat_history
+        full_prompt, context, sources = self._build_prompt(
+            user_message, True, language, history
+        )
+        voice = (LANGUAGE_CONFIGS_TYPED.get(language) or LANGUAGE_CONFIGS_TYPED['en']).tts_voice
+
+        text_parts = []
+        tts_futures = []
+        pending = ""
+        tts_chunk = ""
+
+        with ThreadPoolExecutor(max_workers=self.TTS_MAX_CONCURRENT) as executor:
+            def start_tts(chunks: List[str]):
+                if enable_tts:
+                    tts_futures.extend(executor.submit(self._tts_pcm, chunk, voice) for chunk in chunks)
+
+            try:
+                for chunk in self.client.models.generate_content_stream(
+                    model=self.model,
+                    contents=full_prompt,
+                    config=self._generation_config(temperature=0.7)
+                ):
+                    delta = chunk.text or ""
+                    if not delta:
+                        continue
+                    text_parts.append(delta)
+
+                    # Hand completed sentences to TTS once a full chunk is ready
+                    *sentences, pending = self._SENTENCE_END_RE.split(pending + delta)
+                    ready, tts_chunk = self._group_for_tts(tts_chunk, sentences)
+                    start_tts(ready)
+                ready, tts_chunk = self._group_for_tts(tts_chunk, [pending])
+                start_tts(ready + [tts_chunk] if tts_chunk else ready)
+
+            except Exception as e:
+                for future in tts_futures:
+                    future.cancel()
+                return self._error_result(e)
+
+            # _tts_pcm never raises: a failed chunk drops the audio, not the text
+            pcm_parts = [future.result() for future in tts_futures]
+
+        return self._audio_result(
+            user_message, text_parts, pcm_parts, sources, context, language, history, encode_audio
+        )
 
     def clear_history(self):
         """Clear chat history"""
-        self.chat_history = []
+        self.chat_history.clear()
 
     def get_stats(self) -> Dict:
         """Get engine statistics"""
@@ -314,18 +754,33 @@ You have access to retrieved passages from authentic Breslov texts. Use ONLY the
         }
 
 
+# System prompt + language instruction, rendered once per language
+PRECOMPUTED_PREFIXES = {
+    lang: f"{GUEZIRagEngine.SYSTEM_PROMPT}\n\n\nIMPORTANT: {cfg.instruction}"
+    for lang, cfg in LANGUAGE_CONFIGS_TYPED.items()
+}
+
+
 class ConversationManager:
     """Manages multi-turn conversations with the RAG engine"""
 
     def __init__(self, rag_engine: GUEZIRagEngine):
         self.engine = rag_engine
-        self.sessions: Dict[str, List[Dict]] = {}
-
-    def get_or_create_session(self, session_id: str) -> List[Dict]:
+        self.sessions: Dict[str, Deque[Dict]] = {}
+        # One lock per session: turns of a session are serialized,
+        # different sessions can be handled concurrently
+        self._session_locks: Dict[str, threading.Lock] = {}
+        self._sessions_lock = threading.Lock()
+        # Per-session locks for the async path (used from a single event loop)
+        self._async_session_locks: Dict[str, asyncio.Lock] = {}
+
+    def get_or_create_session(self, session_id: str) -> Deque[Dict]:
         """Get or create a conversation session"""
-        if session_id not in self.sessions:
-            self.sessions[session_id] = []
-        return self.sessions[session_id]
+        with self._sessions_lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = deque(maxlen=self.engine.HISTORY_MAXLEN)
+                self._session_locks[session_id] = threading.Lock()
+            return self.sessions[session_id]
 
     def chat(self, session_id: str, message: str) -> Dict:
         """
@@ -340,24 +795,50 @@ class ConversationManager:
         """
         session = self.get_or_create_session(session_id)
 
-        # Temporarily set engine history to session history
-        original_history = self.engine.chat_history
-        self.engine.chat_history = session
+        # The session history is read and updated in place by the engine
+        with self._session_locks[session_id]:
+            return self.engine.generate_response(message, history=session)
 
-        response = self.engine.generate_response(message)
+    async def achat(self, session_id: str, message: str) -> Dict:
+        """
+        Async variant of chat
 
-        # Update session with new messages
-        self.sessions[session_id] = self.engine.chat_history.copy()
+        Only turns of the same session are serialized; turns of different
+        sessions run concurrently.
 
-        # Restore original history
-        self.engine.chat_history = original_history
+        Args:
+            session_id: Unique session identifier
+            message: User's message
 
-        return response
+        Returns:
+            Response with metadata
+        """
+        session = self.get_or_create_session(session_id)
+
+        lock = self._async_session_locks.get(session_id)
+        if lock is None:
+            lock = self._async_session_locks[session_id] = asyncio.Lock()
+
+        async with lock:
+            return await self.engine.agenerate_response(message, history=session)
+
+    async def achat_many(self, turns: List[Tuple[str, str]]) -> List[Dict]:
+        """
+        Process several (session_id, message) turns concurrently
+
+        Returns:
+            Responses in the same order as turns
+        """
+        return await asyncio.gather(
+            *[self.achat(session_id, message) for session_id, message in turns]
+        )
 
     def end_session(self, session_id: str):
         """End a conversation session"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        with self._sessions_lock:
+            self.sessions.pop(session_id, None)
+            self._session_locks.pop(session_id, None)
+            self._async_session_locks.pop(session_id, None)
 
 
 if __name__ == "__main__":
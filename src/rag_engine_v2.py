@@ -8,18 +8,24 @@ GUEZI RAG Engine V2
 
 import os
 import re
-import base64
+import struct
 import asyncio
-from typing import List, Dict, Optional
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import List, Dict, Optional, Deque, Tuple, AsyncIterator
+import numpy as np
 from google import genai
 from google.genai import types
 
 try:
     from .embeddings import EmbeddingsManager
     from .sefaria_fetcher import SefariaFetcher
+    from .semantic_cache import SemanticCache
 except ImportError:
     from embeddings import EmbeddingsManager
     from sefaria_fetcher import SefariaFetcher
+    from semantic_cache import SemanticCache
 
 
 # Configuration des langues
@@ -42,6 +48,98 @@ LANGUAGE_CONFIGS = {
 }
 
 
+# Références : nombres écrits en toutes lettres et patterns -> modèles.
+# Compilés une fois à l'import, partagés par toutes les instances.
+NUMBER_WORDS = {
+    'first': '1', 'second': '2', 'third': '3', 'fourth': '4', 'fifth': '5',
+    'sixth': '6', 'seventh': '7', 'eighth': '8', 'ninth': '9', 'tenth': '10',
+    'premier': '1', 'deuxième': '2', 'troisième': '3',  # French
+    'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5',
+}
+
+REFERENCE_PATTERNS = {
+    # Likutei Moharan with numbers
+    r'likute?[iy]?\s*moharan\s*(\d+)': 'Likutei Moharan {}',
+    r'likute?[iy]?\s*moharan\s*(?:part\s*)?(?:ii|2)\s*(\d+)': 'Likutei Moharan, Part II {}',
+    r'lm\s*(\d+)': 'Likutei Moharan {}',
+    r'torah\s*(\d+)': 'Likutei Moharan {}',
+    r'teaching\s*(\d+)': 'Likutei Moharan {}',
+    r'lesson\s*(\d+)': 'Likutei Moharan {}',
+    r'enseignement\s*(\d+)': 'Likutei Moharan {}',  # French
+
+    # Other books
+    r'sippure?[iy]?\s*maasiy?ot\s*(\d+)': 'Sippurei Maasiyot {}',
+    r'tale\s*(\d+)': 'Sippurei Maasiyot {}',
+    r'story\s*(\d+)': 'Sippurei Maasiyot {}',
+    r'sichot\s*ha?ran\s*(\d+)': 'Sichot HaRan {}',
+    r'conversation\s*(\d+)': 'Sichot HaRan {}',
+    r'chaye?[iy]?\s*moharan\s*(\d+)': 'Chayei Moharan {}',
+    r'likute?[iy]?\s*tefilot\s*(\d+)': 'Likutei Tefilot, Volume I {}',
+    r'prayer\s*(\d+)': 'Likutei Tefilot, Volume I {}',
+    r'tikkun\s*ha?klali': 'Tikkun HaKlali',
+    r'seven\s*beggars': 'Sippurei Maasiyot 13',
+    r'sept\s*mendiants': 'Sippurei Maasiyot 13',  # French
+}
+
+# Patterns compilés une seule fois. Volontairement pas fusionnés en une
+# seule alternation : avec le moteur `re` de CPython, chaque pattern
+# seul profite de la recherche rapide de son préfixe littéral, alors
+# qu'une alternation essaie toutes les branches à chaque position
+# (~4x plus lent sur une question ordinaire sans référence).
+_COMPILED_REF_PATTERNS: Tuple[Tuple[re.Pattern, str], ...] = tuple(
+    (re.compile(pattern), template)
+    for pattern, template in REFERENCE_PATTERNS.items()
+)
+
+# Une seule alternation pour tous les nombres écrits en toutes lettres
+_NUMBER_ALTERNATION = '|'.join(NUMBER_WORDS)
+_NUMBER_SUB_RE = re.compile(
+    rf'\b({_NUMBER_ALTERNATION})\s+'
+    r'(teaching|lesson|torah|enseignement|tale|story|prayer'
+    r'|likutei|likute|sippurei|sichot|chayei)\b'
+)
+_NUMBER_TEACHING_RE = re.compile(
+    rf'\b({_NUMBER_ALTERNATION})\s+(teaching|lesson|enseignement)\b'
+)
+
+
+def _wav_fmt_chunk(sample_rate: int, channels: int, bits_per_sample: int) -> bytes:
+    """WAV 'fmt ' chunk (PCM) followed by the 'data' chunk id"""
+    byte_rate = sample_rate * channels * bits_per_sample // 8
+    block_align = channels * bits_per_sample // 8
+    return struct.pack(
+        '<4sIHHIIHH4s',
+        b'fmt ', 16, 1, channels, sample_rate, byte_rate, block_align, bits_per_sample, b'data'
+    )
+
+
+def _rerank(query: np.ndarray, docs: np.ndarray) -> np.ndarray:
+    """Similarité cosinus entre la requête et chaque ligne de docs (un seul matmul)"""
+    norms = np.linalg.norm(docs, axis=1) * np.linalg.norm(query)
+    norms[norms == 0] = 1.0
+    return (docs @ query) / norms
+
+
+def _inline_data(parts) -> Optional[bytes]:
+    """Données inline (audio/image) d'une liste de parts, en essayant la part 0 d'abord"""
+    if not parts:
+        return None
+    inline = getattr(parts[0], 'inline_data', None)
+    if inline is not None and inline.data:
+        return inline.data
+    return next(
+        (
+            p.inline_data.data for p in islice(parts, 1, None)
+            if getattr(p, 'inline_data', None) is not None and p.inline_data.data
+        ),
+        None
+    )
+
+
+# En-tête constant pour la sortie TTS Gemini (24 kHz, mono, 16 bits)
+_WAV_FMT_CHUNK_24K_MONO = _wav_fmt_chunk(24000, 1, 16)
+
+
 class GUEZIRagEngineV2:
     """
     RAG Engine amélioré pour les textes de Breslov
@@ -53,6 +151,39 @@ class GUEZIRagEngineV2:
     MODEL_IMAGE = "gemini-2.5-flash-image"
     MODEL_LIVE = "gemini-2.5-flash-native-audio-preview-12-2025"
 
+    # Taille max de l'historique (seuls les HISTORY_PROMPT_MESSAGES derniers sont envoyés)
+    HISTORY_MAXLEN = 32
+    HISTORY_PROMPT_MESSAGES = 4
+
+    # Segments constants de la partie variable du prompt
+    _PASSAGES_HEADER = """=== RETRIEVED PASSAGES (YOU MUST USE THESE TO ANSWER) ===
+IMPORTANT: These passages contain the answer to the user's question!
+- Many are in HEBREW (עברית) - READ and TRANSLATE them to find the answer
+- Look for names, places, dates mentioned in Hebrew script
+- If you see Hebrew text, extract the relevant information from it
+- DO NOT say "I don't have information" - the answer IS in these passages!
+
+"""
+    _PASSAGES_FOOTER = """
+
+=== END OF PASSAGES ==="""
+    _NO_PASSAGES = "No relevant passages found. Inform the user."
+    _QUESTION_HEADER = """
+
+
+FINAL REMINDER: The passages above ARE your knowledge base. If they contain Hebrew text about the topic, READ IT and answer based on it. The word מֶעדְוֶועדִיוְוקֶע means "Medvedevka".
+
+User's question: """
+    _ANSWER_CUE = """
+
+GUEZI (answer using the passages above):"""
+
+    # Numéro final d'une référence ('Likutei Moharan 7' -> 'Likutei Moharan')
+    _REF_NUMBER_RE = re.compile(r'\s+\d+$')
+
+    # Fins de phrase pour le découpage TTS (incl. sof pasuk hébreu)
+    _TTS_SENTENCE_RE = re.compile(r'(?<=[.!?;׃])\s+')
+
     SYSTEM_PROMPT = """You are GUEZI (גואזי), a knowledgeable AI assistant for Rabbi Nachman of Breslov's teachings.
 
 CRITICAL RULES:
@@ -80,7 +211,10 @@ Remember: "There is no despair in the world at all!" (אין שום יאוש ב
     def __init__(
         self,
         api_key: str,
-        embeddings_manager: Optional[EmbeddingsManager] = None
+        embeddings_manager: Optional[EmbeddingsManager] = None,
+        use_semantic_cache: bool = True,
+        embeddings_precision: str = "float32",
+        embeddings_index_type: str = "flat"
     ):
         self.api_key = api_key
         self.client = genai.Client(api_key=api_key)
@@ -92,77 +226,118 @@ Remember: "There is no despair in the world at all!" (אין שום יאוש ב
             self.embeddings = EmbeddingsManager(
                 api_key,
                 persist_dir="./data/faiss_db",
-                collection_name="breslov_chunked"
+                collection_name="breslov_chunked",
+                precision=embeddings_precision,
+                index_type=embeddings_index_type
             )
 
         # Sefaria pour lookups directs
         self.sefaria = SefariaFetcher()
 
-        # Historique
-        self.chat_history: List[Dict] = []
+        # Historique (tampon circulaire)
+        self.chat_history: Deque[Dict] = deque(maxlen=self.HISTORY_MAXLEN)
+
+        # Cache sémantique des recherches (requêtes paraphrasées)
+        self.semantic_cache = SemanticCache() if use_semantic_cache else None
+        # Version du corpus des entrées du cache sémantique
+        self._semantic_cache_corpus = None
 
         # Cache des références connues
         self._build_reference_index()
 
-    def _build_reference_index(self):
-        """Construit un index des références pour recherche directe"""
-        # Number words mapping
-        self.number_words = {
-            'first': '1', 'second': '2', 'third': '3', 'fourth': '4', 'fifth': '5',
-            'sixth': '6', 'seventh': '7', 'eighth': '8', 'ninth': '9', 'tenth': '10',
-            'premier': '1', 'deuxième': '2', 'troisième': '3',  # French
-            'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5',
+        # Préfixes de prompt stables (identiques octet par octet à chaque appel)
+        # pour profiter du cache implicite de préfixe de Gemini (trop courts
+        # pour le minimum de tokens d'un cache explicite)
+        self._prompt_prefixes = {
+            lang: f"{self.SYSTEM_PROMPT}\n\nIMPORTANT: {cfg['instruction']}"
+            for lang, cfg in LANGUAGE_CONFIGS.items()
         }
 
-        self.reference_patterns = {
-            # Likutei Moharan with numbers
-            r'likute?[iy]?\s*moharan\s*(\d+)': 'Likutei Moharan {}',
-            r'likute?[iy]?\s*moharan\s*(?:part\s*)?(?:ii|2)\s*(\d+)': 'Likutei Moharan, Part II {}',
-            r'lm\s*(\d+)': 'Likutei Moharan {}',
-            r'torah\s*(\d+)': 'Likutei Moharan {}',
-            r'teaching\s*(\d+)': 'Likutei Moharan {}',
-            r'lesson\s*(\d+)': 'Likutei Moharan {}',
-            r'enseignement\s*(\d+)': 'Likutei Moharan {}',  # French
-
-            # Other books
-            r'sippure?[iy]?\s*maasiy?ot\s*(\d+)': 'Sippurei Maasiyot {}',
-            r'tale\s*(\d+)': 'Sippurei Maasiyot {}',
-            r'story\s*(\d+)': 'Sippurei Maasiyot {}',
-            r'sichot\s*ha?ran\s*(\d+)': 'Sichot HaRan {}',
-            r'conversation\s*(\d+)': 'Sichot HaRan {}',
-            r'chaye?[iy]?\s*moharan\s*(\d+)': 'Chayei Moharan {}',
-            r'likute?[iy]?\s*tefilot\s*(\d+)': 'Likutei Tefilot, Volume I {}',
-            r'prayer\s*(\d+)': 'Likutei Tefilot, Volume I {}',
-            r'tikkun\s*ha?klali': 'Tikkun HaKlali',
-            r'seven\s*beggars': 'Sippurei Maasiyot 13',
-            r'sept\s*mendiants': 'Sippurei Maasiyot 13',  # French
+    def _build_reference_index(self):
+        """Construit l'index des références pour recherche directe"""
+        # Tables partagées (niveau module), exposées pour compatibilité
+        self.number_words = NUMBER_WORDS
+        self.reference_patterns = REFERENCE_PATTERNS
+
+        # Dernière requête analysée -> référence extraite
+        self._last_reference = (None, None)
+
+        # Index ref (minuscules) -> indices des documents
+        self._build_ref_to_indices()
+
+    def _build_ref_to_indices(self):
+        """Construit les index inversés ref -> indices et livre -> indices à partir des métadonnées"""
+        self._ref_to_indices: Dict[str, List[int]] = defaultdict(list)
+        book_to_indices: Dict[str, List[int]] = defaultdict(list)
+        for i, metadata in enumerate(self.embeddings.metadatas):
+            self._ref_to_indices[metadata.get('ref', '').lower()].append(i)
+            book_to_indices[self._book_key(metadata.get('title', ''))].append(i)
+        self._book_index: Dict[str, np.ndarray] = {
+            book: np.asarray(indices, dtype=np.int64)
+            for book, indices in book_to_indices.items()
         }
+        self._ref_index_version = self._ref_index_key()
+
+    @staticmethod
+    def _book_key(title: str) -> str:
+        """Clé de livre normalisée ('Sippurei_Maasiyot' == 'Sippurei Maasiyot')"""
+        return title.replace('_', ' ').strip().lower()
+
+    def _book_subset(self, ref: Optional[str]) -> Optional[np.ndarray]:
+        """Indices des documents du livre d'une référence (None = tout le corpus)"""
+        if not ref:
+            return None
+        if self._ref_index_key() != self._ref_index_version:
+            self._build_ref_to_indices()
+        # 'Likutei Moharan 7' -> 'likutei moharan'
+        return self._book_index.get(self._book_key(self._REF_NUMBER_RE.sub('', ref)))
+
+    def _semantic_search(self, query: str, n_results: int, query_embedding, ref: Optional[str]) -> List[Dict]:
+        """Recherche sémantique, restreinte au livre de la référence si elle est connue"""
+        subset = self._book_subset(ref)
+        if subset is None:
+            return self.embeddings.search(query, n_results=n_results, query_embedding=query_embedding)
+        return self.embeddings.search(
+            query,
+            n_results=n_results,
+            query_embedding=query_embedding,
+            subset=subset
+        )
+
+    def _ref_index_key(self):
+        """Clé de fraîcheur de l'index : version du corpus et nombre de documents
+        (pour les gestionnaires d'embeddings sans attribut `version`)"""
+        return getattr(self.embeddings, 'version', None), len(self.embeddings.metadatas)
 
     def _extract_reference(self, query: str) -> Optional[str]:
-        """Extrait une référence de livre du texte"""
+        """Extrait une référence de livre du texte (mémoïsé sur la dernière requête)"""
+        last_query, last_ref = self._last_reference
+        if query == last_query:
+            return last_ref
+
+        ref = self._parse_reference(query)
+        self._last_reference = (query, ref)
+        return ref
+
+    def _parse_reference(self, query: str) -> Optional[str]:
+        """Applique les patterns de référence au texte"""
         query_lower = query.lower()
 
         # First, convert word numbers to digits for common patterns
-        for word, digit in self.number_words.items():
-            # "first teaching", "premier enseignement"
-            query_lower = re.sub(
-                rf'\b{word}\s+(teaching|lesson|torah|enseignement|tale|story|prayer)\b',
-                rf'\1 {digit}',
-                query_lower
-            )
-            # "the first Torah", "first Likutei Moharan"
-            query_lower = re.sub(
-                rf'\b{word}\s+(likutei|likute|sippurei|sichot|chayei)\b',
-                rf'\1 {digit}',
-                query_lower
-            )
-            # Just "first teaching" without book name -> assume Likutei Moharan
-            if re.search(rf'\b{word}\s+(teaching|lesson|enseignement)\b', query.lower()):
-                query_lower = query_lower.replace(f'{word} ', f'teaching {digit} ')
+        # "first teaching", "premier enseignement", "first Likutei Moharan"
+        original_lower = query_lower
+        query_lower = _NUMBER_SUB_RE.sub(
+            lambda m: f"{m.group(2)} {NUMBER_WORDS[m.group(1)]}",
+            query_lower
+        )
+        # Just "first teaching" without book name -> assume Likutei Moharan
+        teaching_words = dict.fromkeys(m.group(1) for m in _NUMBER_TEACHING_RE.finditer(original_lower))
+        for word in teaching_words:
+            query_lower = query_lower.replace(f'{word} ', f'teaching {NUMBER_WORDS[word]} ')
 
         # Try standard patterns
-        for pattern, template in self.reference_patterns.items():
-            match = re.search(pattern, query_lower)
+        for pattern, template in _COMPILED_REF_PATTERNS:
+            match = pattern.search(query_lower)
             if match:
                 if match.groups():
                     return template.format(match.group(1))
@@ -172,65 +347,245 @@ Remember: "There is no despair in the world at all!" (אין שום יאוש ב
 
     def _search_by_reference(self, ref: str, n_results: int = 3) -> List[Dict]:
         """Recherche par référence exacte dans les métadonnées"""
-        results = []
-
-        for i, metadata in enumerate(self.embeddings.metadatas):
-            if metadata.get('ref', '').lower() == ref.lower():
-                results.append({
-                    'id': f'doc_{i}',
-                    'text': self.embeddings.documents[i],
-                    'metadata': metadata,
-                    'relevance_score': 1.0,
-                    'match_type': 'exact_reference'
-                })
-
-        return results[:n_results]
+        # Reconstruire l'index si le corpus a changé
+        if self._ref_index_key() != self._ref_index_version:
+            self._build_ref_to_indices()
+
+        indices = self._ref_to_indices.get(ref.lower(), [])[:n_results]
+
+        return [
+            {
+                'id': f'doc_{i}',
+                'text': self.embeddings.documents[i],
+                'text_preview_1500': self.embeddings.text_previews[i],
+                'metadata': self.embeddings.metadatas[i],
+                'relevance_score': 1.0,
+                'match_type': 'exact_reference'
+            }
+            for i in indices
+        ]
 
     def hybrid_search(self, query: str, n_results: int = 7) -> List[Dict]:
         """
         Recherche hybride: référence exacte + sémantique
         """
-        results = []
-
         # 1. Essayer d'extraire une référence
         ref = self._extract_reference(query)
-        if ref:
-            ref_results = self._search_by_reference(ref, n_results=3)
-            results.extend(ref_results)
 
-        # 2. Recherche sémantique
-        semantic_results = self.embeddings.search(query, n_results=n_results)
+        # Embedding de la requête, calculé une seule fois (cache, recherche, rerank)
+        query_embedding = self._query_embedding(query)
+
+        cache_namespace = self._cache_namespace(ref)
+        cached = self._cached_search(query_embedding, cache_namespace, n_results)
+        if cached is not None:
+            return cached
+
+        ref_results = self._search_by_reference(ref, n_results=3) if ref else []
+
+        # 2. Recherche sémantique (filtrée par livre si une référence est détectée)
+        semantic_results = self._semantic_search(query, n_results, query_embedding, ref)
+
+        return self._merge_results(ref_results, semantic_results, query_embedding, cache_namespace, n_results)
+
+    async def ahybrid_search(self, query: str, n_results: int = 7) -> List[Dict]:
+        """
+        Version asynchrone de hybrid_search : la recherche par référence et la
+        recherche sémantique tournent en parallèle dans des threads
+        """
+        ref = self._extract_reference(query)
+
+        query_embedding = await asyncio.to_thread(self._query_embedding, query)
+
+        cache_namespace = self._cache_namespace(ref)
+        cached = self._cached_search(query_embedding, cache_namespace, n_results)
+        if cached is not None:
+            return cached
+
+        ref_results, semantic_results = await asyncio.gather(
+            asyncio.to_thread(self._search_by_reference, ref, 3) if ref else asyncio.sleep(0, []),
+            asyncio.to_thread(self._semantic_search, query, n_results, query_embedding, ref)
+        )
+
+        return self._merge_results(ref_results, semantic_results, query_embedding, cache_namespace, n_results)
+
+    def _query_embedding(self, query: str):
+        """Embedding de la requête, ou None si l'API n'a rien renvoyé"""
+        query_embedding = self.embeddings.get_embedding(query)
+        return query_embedding if len(query_embedding) else None
+
+    def _cache_namespace(self, ref: Optional[str]) -> Tuple:
+        """
+        Clé du cache sémantique: référence et version du corpus, pour ne jamais
+        servir des résultats d'avant un add_documents ou une reconstruction
+        d'index (le cache est alors vidé)
+        """
+        corpus_key = self._ref_index_key()
+        if self.semantic_cache is not None and corpus_key != self._semantic_cache_corpus:
+            self.semantic_cache.clear()
+            self._semantic_cache_corpus = corpus_key
+        return ref, corpus_key
+
+    def _cached_search(self, query_embedding, namespace: Tuple, n_results: int) -> Optional[List[Dict]]:
+        """Cache sémantique: une requête proche (même référence) réutilise le résultat"""
+        if self.semantic_cache is None or query_embedding is None:
+            return None
+        cached = self.semantic_cache.get(query_embedding, namespace=namespace)
+        if cached is not None and cached[0] >= n_results:
+            return cached[1][:n_results]
+        return None
+
+    def _merge_results(
+        self,
+        ref_results: List[Dict],
+        semantic_results: List[Dict],
+        query_embedding,
+        cache_namespace: Tuple,
+        n_results: int
+    ) -> List[Dict]:
+        """Combine, déduplique, rerank et met en cache les résultats"""
+        results = list(ref_results)
 
         # Combiner et dédupliquer
         seen_refs = {r['metadata'].get('ref') for r in results}
         for sr in semantic_results:
-            if sr['metadata'].get('ref') not in seen_refs:
+            ref_key = sr['metadata'].get('ref')
+            if ref_key not in seen_refs:
                 sr['match_type'] = 'semantic'
                 results.append(sr)
-                seen_refs.add(sr['metadata'].get('ref'))
+                seen_refs.add(ref_key)
+
+        # 3. Rerank cosinus des candidats
+        results = self._rerank_results(results, query_embedding)
 
-        return results[:n_results]
+        results = results[:n_results]
+        if self.semantic_cache is not None and query_embedding is not None:
+            self.semantic_cache.put(query_embedding, (n_results, results), namespace=cache_namespace)
 
-    def retrieve_context(self, query: str, n_results: int = 7) -> str:
-        """Récupère le contexte avec recherche hybride"""
+        return results
+
+    def _rerank_results(self, results: List[Dict], query_embedding) -> List[Dict]:
+        """
+        Trie les candidats par similarité cosinus avec la requête.
+        Les correspondances de référence exacte restent en tête.
+        """
+        if query_embedding is None or len(results) < 2 or not hasattr(self.embeddings, 'get_vectors'):
+            return results
+
+        indices = [int(r['id'].split('_', 1)[1]) for r in results]
+        scores = _rerank(np.asarray(query_embedding, dtype=np.float32), self.embeddings.get_vectors(indices))
+
+        for result, score in zip(results, scores):
+            result['rerank_score'] = float(score)
+
+        return sorted(
+            results,
+            key=lambda r: (r.get('match_type') != 'exact_reference', -r['rerank_score'])
+        )
+
+    def retrieve_context(self, query: str, n_results: int = 7) -> Tuple[str, List[Dict]]:
+        """
+        Récupère le contexte avec recherche hybride
+        Retourne (contexte formaté, résultats de recherche)
+        """
         results = self.hybrid_search(query, n_results=n_results)
+        return self._format_context(results), results
 
+    async def aretrieve_context(self, query: str, n_results: int = 7) -> Tuple[str, List[Dict]]:
+        """Version asynchrone de retrieve_context"""
+        results = await self.ahybrid_search(query, n_results=n_results)
+        return self._format_context(results), results
+
+    def _format_context(self, results: List[Dict]) -> str:
+        """Formate les résultats de recherche en contexte pour le prompt"""
         if not results:
             return ""
 
-        context_parts = []
-        for i, doc in enumerate(results, 1):
-            ref = doc['metadata'].get('ref', 'Unknown')
-            title = doc['metadata'].get('title', '')
-            text = doc.get('text', '')
-            match_type = doc.get('match_type', 'unknown')
+        context_parts = [None] * len(results)
+        for i, doc in enumerate(results):
+            metadata = doc['metadata']
+            preview = doc.get('text_preview_1500')
+            if preview is None:
+                preview = doc.get('text', '')[:1500]
+            context_parts[i] = (
+                f"[Source {i + 1}: {metadata.get('title', '')} - {metadata.get('ref', 'Unknown')}]\n"
+                f"Content: {preview}\n"
+            )
 
-            part = f"[Source {i}: {title} - {ref}]\n"
-            part += f"Content: {text[:1500]}\n"
+        return "\n---\n".join(context_parts)
 
-            context_parts.append(part)
+    def _build_contents(self, user_message: str, context: str, language: str) -> Tuple[str, str]:
+        """
+        Construit la partie variable de la requête (le préfixe stable, system
+        prompt + langue, est ajouté à l'envoi). Retourne (prompt, clé de langue)
+        """
+        language_key = language if language in self._prompt_prefixes else 'en'
 
-        return "\n---\n".join(context_parts)
+        passages = (
+            f"{self._PASSAGES_HEADER}{context}{self._PASSAGES_FOOTER}"
+            if context else self._NO_PASSAGES
+        )
+
+        # Historique
+        history_text = ""
+        if self.chat_history:
+            # Derniers messages lus depuis la fin du deque, remis dans l'ordre
+            recent = list(islice(reversed(self.chat_history), self.HISTORY_PROMPT_MESSAGES))
+            recent.reverse()
+            history_text = "\n\n\nPrevious conversation:\n" + "".join(
+                f"{'User' if msg['role'] == 'user' else 'GUEZI'}: {msg['content'][:300]}\n"
+                for msg in recent
+            )
+
+        # Un seul gabarit: les segments constants ne sont pas recopiés dans une liste
+        dynamic_prompt = f"{passages}{history_text}{self._QUESTION_HEADER}{user_message}{self._ANSWER_CUE}"
+        return dynamic_prompt, language_key
+
+    def _contents(self, dynamic_prompt: str, language: str) -> List[str]:
+        """Préfixe stable en première partie, puis la partie variable"""
+        return [self._prompt_prefixes[language], dynamic_prompt]
+
+    def _chat_config(self, temperature: float) -> types.GenerateContentConfig:
+        """Configuration de requête de chat"""
+        return types.GenerateContentConfig(
+            temperature=temperature,
+            max_output_tokens=2048,
+        )
+
+    def _generate_chat(self, dynamic_prompt: str, language: str, temperature: float) -> str:
+        """Appel de génération avec le préfixe stable"""
+        return self.client.models.generate_content(
+            model=self.MODEL_CHAT,
+            contents=self._contents(dynamic_prompt, language),
+            config=self._chat_config(temperature)
+        ).text
+
+    async def _agenerate_chat(self, dynamic_prompt: str, language: str, temperature: float) -> str:
+        """Version asynchrone de _generate_chat"""
+        response = await self.client.aio.models.generate_content(
+            model=self.MODEL_CHAT,
+            contents=self._contents(dynamic_prompt, language),
+            config=self._chat_config(temperature)
+        )
+        return response.text
+
+    def _format_result(self, response_text: str, sources: List[Dict], context: str, language: str) -> Dict:
+        """Formate la réponse retournée à l'interface"""
+        return {
+            'response': response_text,
+            'sources': [
+                {
+                    'title': s['metadata'].get('title', ''),
+                    'ref': s['metadata'].get('ref', ''),
+                    'relevance': s.get('relevance_score', 0),
+                    'match_type': s.get('match_type', 'semantic'),
+                    'text_preview': s.get('text', '')[:300]  # Add text preview for debug
+                }
+                for s in sources
+            ],
+            'language': language,
+            'context_found': bool(context),
+            'debug_context': context[:2000] if context else None  # Add context for debug
+        }
 
     def generate_response(
         self,
@@ -240,82 +595,50 @@ Remember: "There is no despair in the world at all!" (אין שום יאוש ב
     ) -> Dict:
         """Génère une réponse RAG"""
 
-        # Contexte
-        context = self.retrieve_context(user_message, n_results=7)
-        sources = self.hybrid_search(user_message, n_results=5)
-
-        # Config langue
-        lang_config = LANGUAGE_CONFIGS.get(language, LANGUAGE_CONFIGS['en'])
-
-        # Construction du prompt
-        prompt_parts = [self.SYSTEM_PROMPT]
-        prompt_parts.append(f"\nIMPORTANT: {lang_config['instruction']}")
+        # Contexte (les sources sont les 5 premiers résultats de la même recherche)
+        context, results = self.retrieve_context(user_message, n_results=7)
+        sources = results[:5]
 
-        if context:
-            prompt_parts.append(f"""
-
-=== RETRIEVED PASSAGES (YOU MUST USE THESE TO ANSWER) ===
-IMPORTANT: These passages contain the answer to the user's question!
-- Many are in HEBREW (עברית) - READ and TRANSLATE them to find the answer
-- Look for names, places, dates mentioned in Hebrew script
-- If you see Hebrew text, extract the relevant information from it
-- DO NOT say "I don't have information" - the answer IS in these passages!
+        dynamic_prompt, language_key = self._build_contents(user_message, context, language)
 
-{context}
+        try:
+            response_text = self._generate_chat(dynamic_prompt, language_key, temperature)
 
-=== END OF PASSAGES ===""")
-        else:
-            prompt_parts.append("\n\nNo relevant passages found. Inform the user.")
+            # Mise à jour historique
+            self.chat_history.append({'role': 'user', 'content': user_message})
+            self.chat_history.append({'role': 'assistant', 'content': response_text})
 
-        # Historique
-        if self.chat_history:
-            history_text = "\n\nPrevious conversation:\n"
-            for msg in self.chat_history[-4:]:
-                role = "User" if msg['role'] == 'user' else "GUEZI"
-                history_text += f"{role}: {msg['content'][:300]}\n"
-            prompt_parts.append(history_text)
+            return self._format_result(response_text, sources, context, language)
 
-        prompt_parts.append(f"""
+        except Exception as e:
+            return {
+                'response': f"Error: {str(e)}",
+                'sources': [],
+                'error': str(e)
+            }
 
-FINAL REMINDER: The passages above ARE your knowledge base. If they contain Hebrew text about the topic, READ IT and answer based on it. The word מֶעדְוֶועדִיוְוקֶע means "Medvedevka".
+    async def agenerate_response(
+        self,
+        user_message: str,
+        language: str = 'en',
+        temperature: float = 0.3
+    ) -> Dict:
+        """Version asynchrone de generate_response"""
 
-User's question: {user_message}
+        # Contexte (embedding et recherches dans des threads)
+        context, results = await self.aretrieve_context(user_message, 7)
+        sources = results[:5]
 
-GUEZI (answer using the passages above):""")
-        full_prompt = "\n".join(prompt_parts)
+        dynamic_prompt, language_key = self._build_contents(user_message, context, language)
 
         try:
-            response = self.client.models.generate_content(
-                model=self.MODEL_CHAT,
-                contents=full_prompt,
-                config=types.GenerateContentConfig(
-                    temperature=temperature,
-                    max_output_tokens=2048,
-                )
-            )
-
-            response_text = response.text
+            response_text = await self._agenerate_chat(dynamic_prompt, language_key, temperature)
 
             # Mise à jour historique
             self.chat_history.append({'role': 'user', 'content': user_message})
             self.chat_history.append({'role': 'assistant', 'content': response_text})
 
-            return {
-                'response': response_text,
-                'sources': [
-                    {
-                        'title': s['metadata'].get('title', ''),
-                        'ref': s['metadata'].get('ref', ''),
-                        'relevance': s.get('relevance_score', 0),
-                        'match_type': s.get('match_type', 'semantic'),
-                        'text_preview': s.get('text', '')[:300]  # Add text preview for debug
-                    }
-                    for s in sources
-                ],
-                'language': language,
-                'context_found': bool(context),
-                'debug_context': context[:2000] if context else None  # Add context for debug
-            }
+            return self._format_result(response_text, sources, context, language)
 
         except Exception as e:
             return {
@@ -324,46 +647,147 @@ GUEZI (answer using the passages above):""")
                 'error': str(e)
             }
 
-    def text_to_speech(self, text: str, voice: str = "Kore") -> Optional[bytes]:
+    async def astream_response(
+        self,
+        user_message: str,
+        language: str = 'en',
+        temperature: float = 0.3
+    ) -> AsyncIterator[Dict]:
         """
-        TTS with Gemini 2.5 Flash TTS
-        Returns WAV audio bytes
+        Version streaming de generate_response
+
+        Yields, dans l'ordre:
+            {'type': 'text', 'text': ...}    texte généré au fil de l'eau
+            {'type': 'done', 'result': ...}  résultat final (comme generate_response)
+
+        L'historique n'est mis à jour qu'à la fin du stream.
         """
+        context, results = await self.aretrieve_context(user_message, 7)
+        sources = results[:5]
+
+        dynamic_prompt, language_key = self._build_contents(user_message, context, language)
+
+        text_parts = []
         try:
-            # Clean and prepare text for TTS
-            clean_text = text.replace('\n', ' ').strip()
-            if not clean_text:
-                return None
+            stream = await self.client.aio.models.generate_content_stream(
+                model=self.MODEL_CHAT,
+                contents=self._contents(dynamic_prompt, language_key),
+                config=self._chat_config(temperature)
+            )
+            async for chunk in stream:
+                if chunk.text:
+                    text_parts.append(chunk.text)
+                    yield {'type': 'text', 'text': chunk.text}
 
-            # Create TTS request with proper configuration
-            response = self.client.models.generate_content(
-                model=self.MODEL_TTS,
-                contents=f"Please read this text aloud: {clean_text}",
-                config=types.GenerateContentConfig(
-                    response_modalities=["AUDIO"],
-                    speech_config=types.SpeechConfig(
-                        voice_config=types.VoiceConfig(
-                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                voice_name=voice
-                            )
-                        )
+        except Exception as e:
+            yield {
+                'type': 'done',
+                'result': {
+                    'response': f"Error: {str(e)}",
+                    'sources': [],
+                    'error': str(e)
+                }
+            }
+            return
+
+        response_text = "".join(text_parts)
+        self.chat_history.append({'role': 'user', 'content': user_message})
+        self.chat_history.append({'role': 'assistant', 'content': response_text})
+
+        yield {'type': 'done', 'result': self._format_result(response_text, sources, context, language)}
+
+    def _split_for_tts(self, text: str, max_chars: int = 400) -> List[str]:
+        """
+        Découpe le texte aux fins de phrase (., !, ?, ;, ׃) en morceaux
+        d'au plus ~max_chars caractères pour la synthèse en parallèle
+        """
+        sentences = self._TTS_SENTENCE_RE.split(text.replace('\n', ' ').strip())
+
+        chunks = []
+        current = ""
+        for sentence in sentences:
+            if not sentence:
+                continue
+            if current and len(current) + len(sentence) + 1 > max_chars:
+                chunks.append(current)
+                current = sentence
+            else:
+                current = f"{current} {sentence}" if current else sentence
+        if current:
+            chunks.append(current)
+
+        return chunks
+
+    def _tts_config(self, voice: str) -> types.GenerateContentConfig:
+        """Configuration de requête TTS"""
+        return types.GenerateContentConfig(
+            response_modalities=["AUDIO"],
+            speech_config=types.SpeechConfig(
+                voice_config=types.VoiceConfig(
+                    prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                        voice_name=voice
                     )
                 )
             )
+        )
 
-            # Extract audio from response
-            if response.candidates:
-                for candidate in response.candidates:
-                    if candidate.content and candidate.content.parts:
-                        for part in candidate.content.parts:
-                            if hasattr(part, 'inline_data') and part.inline_data:
-                                audio_data = part.inline_data.data
-                                if audio_data:
-                                    # Convert raw PCM to WAV format
-                                    return self._pcm_to_wav(audio_data, sample_rate=24000)
-
-            print("TTS: No audio data in response")
-            return None
+    @staticmethod
+    def _tts_audio(response) -> Optional[bytes]:
+        """PCM brut d'une réponse TTS"""
+        for candidate in response.candidates or ():
+            if candidate.content:
+                audio = _inline_data(candidate.content.parts)
+                if audio:
+                    return audio
+
+        return None
+
+    def _tts_one_sync(self, text: str, voice: str) -> Optional[bytes]:
+        """Synthétise un morceau de texte (client synchrone), retourne le PCM brut"""
+        return self._tts_audio(self.client.models.generate_content(
+            model=self.MODEL_TTS,
+            contents=f"Please read this text aloud: {text}",
+            config=self._tts_config(voice)
+        ))
+
+    async def _tts_one(self, text: str, voice: str, semaphore: asyncio.Semaphore) -> Optional[bytes]:
+        """Synthétise un morceau de texte, retourne le PCM brut"""
+        async with semaphore:
+            response = await self.client.aio.models.generate_content(
+                model=self.MODEL_TTS,
+                contents=f"Please read this text aloud: {text}",
+                config=self._tts_config(voice)
+            )
+
+        return self._tts_audio(response)
+
+    async def atext_to_speech(
+        self,
+        text: str,
+        voice: str = "Kore",
+        max_concurrent: int = 4
+    ) -> Optional[bytes]:
+        """
+        TTS with Gemini 2.5 Flash TTS, phrase par phrase en parallèle
+        Returns WAV audio bytes
+        """
+        try:
+            chunks = self._split_for_tts(text)
+            if not chunks:
+                return None
+
+            # Limite de concurrence pour respecter les quotas de l'API
+            semaphore = asyncio.Semaphore(max_concurrent)
+            pcm_parts = await asyncio.gather(
+                *[self._tts_one(chunk, voice, semaphore) for chunk in chunks]
+            )
+
+            if not all(pcm_parts):
+                print("TTS: No audio data in response")
+                return None
+
+            # Concaténer le PCM puis un seul en-tête WAV
+            return self._pcm_to_wav(b''.join(pcm_parts), sample_rate=24000)
 
         except Exception as e:
             print(f"TTS error: {e}")
@@ -371,40 +795,55 @@ GUEZI (answer using the passages above):""")
             traceback.print_exc()
             return None
 
-    def _pcm_to_wav(self, pcm_data: bytes, sample_rate: int = 24000, channels: int = 1, bits_per_sample: int = 16) -> bytes:
-        """Convert raw PCM audio to WAV format"""
-        import struct
-        import io
+    def text_to_speech(self, text: str, voice: str = "Kore", max_concurrent: int = 4) -> Optional[bytes]:
+        """
+        TTS with Gemini 2.5 Flash TTS
+        Returns WAV audio bytes
 
-        # WAV file parameters
-        byte_rate = sample_rate * channels * bits_per_sample // 8
-        block_align = channels * bits_per_sample // 8
-        data_size = len(pcm_data)
+        Version synchrone d'atext_to_speech: les morceaux sont synthétisés en
+        parallèle dans des threads (client synchrone, sans boucle asyncio),
+        donc utilisable depuis Streamlit comme depuis une boucle en cours.
+        """
+        try:
+            chunks = self._split_for_tts(text)
+            if not chunks:
+                return None
 
-        # Create WAV header
-        wav_buffer = io.BytesIO()
+            with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+                pcm_parts = list(executor.map(
+                    lambda chunk: self._tts_one_sync(chunk, voice), chunks
+                ))
 
-        # RIFF header
-        wav_buffer.write(b'RIFF')
-        wav_buffer.write(struct.pack('<I', 36 + data_size))  # File size - 8
-        wav_buffer.write(b'WAVE')
+            if not all(pcm_parts):
+                print("TTS: No audio data in response")
+                return None
 
-        # fmt chunk
-        wav_buffer.write(b'fmt ')
-        wav_buffer.write(struct.pack('<I', 16))  # Chunk size
-        wav_buffer.write(struct.pack('<H', 1))   # Audio format (PCM)
-        wav_buffer.write(struct.pack('<H', channels))
-        wav_buffer.write(struct.pack('<I', sample_rate))
-        wav_buffer.write(struct.pack('<I', byte_rate))
-        wav_buffer.write(struct.pack('<H', block_align))
-        wav_buffer.write(struct.pack('<H', bits_per_sample))
+            return self._pcm_to_wav(b''.join(pcm_parts), sample_rate=24000)
 
-        # data chunk
-        wav_buffer.write(b'data')
-        wav_buffer.write(struct.pack('<I', data_size))
-        wav_buffer.write(pcm_data)
+        except Exception as e:
+            print(f"TTS error: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
 
-        return wav_buffer.getvalue()
+    def _pcm_to_wav(self, pcm_data: bytes, sample_rate: int = 24000, channels: int = 1, bits_per_sample: int = 16) -> bytes:
+        """Convert raw PCM audio to WAV format"""
+        if (sample_rate, channels, bits_per_sample) == (24000, 1, 16):
+            fmt_chunk = _WAV_FMT_CHUNK_24K_MONO
+        else:
+            fmt_chunk = _wav_fmt_chunk(sample_rate, channels, bits_per_sample)
+
+        data_size = len(pcm_data)
+
+        # RIFF header + fmt chunk + data chunk, assembled in a single allocation
+        return b''.join((
+            b'RIFF',
+            struct.pack('<I', 36 + data_size),  # File size - 8
+            b'WAVE',
+            fmt_chunk,
+            struct.pack('<I', data_size),
+            pcm_data
+        ))
 
     def generate_image(self, prompt: str) -> Optional[bytes]:
         """
@@ -423,18 +862,14 @@ GUEZI (answer using the passages above):""")
             )
 
             # Extraire l'image
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    return part.inline_data.data
-
-            return None
+            return _inline_data(response.parts)
         except Exception as e:
             print(f"Image generation error: {e}")
             return None
 
     def clear_history(self):
         """Efface l'historique"""
-        self.chat_history = []
+        self.chat_history.clear()
 
     def get_stats(self) -> Dict:
         """Statistiques"""
@@ -443,7 +878,8 @@ GUEZI (answer using the passages above):""")
             'tts_model': self.MODEL_TTS,
             'image_model': self.MODEL_IMAGE,
             'chat_history': len(self.chat_history),
-            'embeddings': self.embeddings.get_collection_stats()
+            'embeddings': self.embeddings.get_collection_stats(),
+            'semantic_cache': self.semantic_cache.get_statistics() if self.semantic_cache else None
         }
 
 
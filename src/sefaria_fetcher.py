@@ -5,10 +5,105 @@ Fetches Rabbi Nachman of Breslov texts from Sefaria.org
 
 import requests
 import json
-from typing import List, Dict, Optional
+import asyncio
+import importlib.util
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import List, Dict, Optional, Iterable, Iterator
 from tqdm import tqdm
 import time
 
+# Optional fast JSON serializer for the corpus file
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Optional incremental parser for legacy JSON-array corpus files
+try:
+    import ijson
+    IJSON_AVAILABLE = True
+except ImportError:
+    IJSON_AVAILABLE = False
+
+# Optional async HTTP client (HTTP/2 when the h2 extra is installed)
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+    HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+except ImportError:
+    HTTPX_AVAILABLE = False
+    HTTP2_AVAILABLE = False
+
+
+def dump_ndjson_line(doc: Dict) -> bytes:
+    """One NDJSON line (UTF-8, no ASCII escaping)"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(doc) + b"\n"
+    return (json.dumps(doc, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+def load_corpus(path: str) -> List[Dict]:
+    """
+    Load a corpus file: NDJSON (one document per line, as written by
+    SefariaFetcher) or a legacy JSON array
+    """
+    with open(path, 'rb') as f:
+        head = f.read(64).lstrip()
+        f.seek(0)
+        if head.startswith(b'['):
+            return json.load(f)
+        loads = orjson.loads if ORJSON_AVAILABLE else json.loads
+        return [loads(line) for line in f if line.strip()]
+
+
+def iter_corpus(path: str) -> Iterator[Dict]:
+    """
+    Yield the documents of a corpus file one at a time (same formats as
+    load_corpus), without holding the whole corpus in memory
+    """
+    with open(path, 'rb') as f:
+        head = f.read(64).lstrip()
+        f.seek(0)
+        if head.startswith(b'['):
+            if IJSON_AVAILABLE:
+                yield from ijson.items(f, 'item', use_float=True)
+            else:
+                yield from json.load(f)
+            return
+        loads = orjson.loads if ORJSON_AVAILABLE else json.loads
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+class RateLimiter:
+    """Thread-safe token bucket: at most `rate` acquisitions per second, bursts of `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
 class SefariaFetcher:
     """Fetch Jewish texts from Sefaria API"""
 
@@ -34,12 +129,31 @@ class SefariaFetcher:
         "Chayei_Moharan",            # Life of Rabbi Nachman
     ]
 
+    # Corpus download: parallel workers, politely rate limited
+    FETCH_WORKERS = 8
+    REQUESTS_PER_SECOND = 4
+
     def __init__(self):
         self.session = requests.Session()
         self.session.headers.update({
-            'User-Agent': 'GUEZI-RAG-Chatbot/1.0'
+            'User-Agent': 'GUEZI-RAG-Chatbot/1.0',
+            'Accept-Encoding': 'gzip, deflate'
         })
 
+        # Keep-alive connection pool sized for the parallel corpus fetch,
+        # with retries (and backoff) on transient errors
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=(429, 500, 502, 503, 504)
+            )
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
     def get_text(self, ref: str, with_commentary: bool = False) -> Dict:
         """
         Fetch a specific text by reference
@@ -64,6 +178,24 @@ class SefariaFetcher:
             print(f"Error fetching {ref}: {e}")
             return {}
 
+    async def get_text_async(self, ref: str, client: Optional["httpx.AsyncClient"] = None) -> Dict:
+        """
+        Async variant of get_text
+
+        Uses the given httpx client, or the pooled requests session in a
+        worker thread when httpx is not installed.
+        """
+        if client is None:
+            return await asyncio.to_thread(self.get_text, ref)
+
+        try:
+            response = await client.get(f"{self.BASE_URL}/texts/{ref}")
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            print(f"Error fetching {ref}: {e}")
+            return {}
+
     def get_index(self, title: str) -> Dict:
         """Get the index/structure of a book"""
         url = f"{self.BASE_URL}/v2/index/{title}"
@@ -135,39 +267,94 @@ class SefariaFetcher:
             print(f"Error searching for '{query}': {e}")
             return {}
 
-    def fetch_breslov_corpus(self, save_path: str = "data/breslov_corpus.json") -> List[Dict]:
+    def fetch_breslov_corpus(self, save_path: str = "data/breslov_corpus.ndjson") -> List[Dict]:
         """
-        Fetch all Breslov texts and save to file
+        Fetch all Breslov texts and save to file (NDJSON, see load_corpus)
 
         Returns:
             List of text documents
         """
-        corpus = []
-        all_texts = self.BRESLOV_TEXTS + self.RELATED_TEXTS
+        self.save_breslov_corpus(save_path)
+        return load_corpus(save_path)
 
-        print("Fetching Breslov corpus from Sefaria...")
-        for text_title in tqdm(all_texts):
-            print(f"\nFetching: {text_title}")
+    def save_breslov_corpus(self, save_path: str = "data/breslov_corpus.ndjson") -> int:
+        """
+        Fetch all Breslov texts into an NDJSON file (see load_corpus)
+
+        Each book is written out as soon as it is processed and the corpus is
+        never held in memory; use iter_corpus to read it back.
+
+        Returns:
+            Number of documents written
+        """
+        all_texts = self.BRESLOV_TEXTS + self.RELATED_TEXTS
+        limiter = RateLimiter(self.REQUESTS_PER_SECOND, capacity=self.FETCH_WORKERS)
 
-            # Get the full text
+        def fetch(text_title: str) -> List[Dict]:
+            # Be nice to the API
+            limiter.acquire()
             text_data = self.get_text(text_title)
             if not text_data:
-                continue
+                return []
+            return self._process_text_data(text_title, text_data)
 
-            # Process the text
-            documents = self._process_text_data(text_title, text_data)
-            corpus.extend(documents)
+        print("Fetching Breslov corpus from Sefaria...")
+        count = 0
+        with open(save_path, 'wb') as f, ThreadPoolExecutor(max_workers=self.FETCH_WORKERS) as executor:
+            # map() keeps the book order of all_texts
+            for documents in tqdm(executor.map(fetch, all_texts), total=len(all_texts)):
+                self._write_documents(f, documents)
+                count += len(documents)
 
-            # Be nice to the API
-            time.sleep(0.5)
+        print(f"\nSaved {count} documents to {save_path}")
+        return count
 
-        # Save corpus
-        with open(save_path, 'w', encoding='utf-8') as f:
-            json.dump(corpus, f, ensure_ascii=False, indent=2)
+    async def afetch_breslov_corpus(self, save_path: str = "data/breslov_corpus.ndjson") -> List[Dict]:
+        """
+        Async variant of fetch_breslov_corpus: all books are requested
+        concurrently (at most FETCH_WORKERS in flight)
 
-        print(f"\nSaved {len(corpus)} documents to {save_path}")
+        Returns:
+            List of text documents
+        """
+        all_texts = self.BRESLOV_TEXTS + self.RELATED_TEXTS
+        semaphore = asyncio.Semaphore(self.FETCH_WORKERS)
+
+        async def fetch(text_title: str, client) -> List[Dict]:
+            async with semaphore:
+                text_data = await self.get_text_async(text_title, client)
+            if not text_data:
+                return []
+            return self._process_text_data(text_title, text_data)
+
+        print("Fetching Breslov corpus from Sefaria...")
+        if HTTPX_AVAILABLE:
+            async with httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                headers=dict(self.session.headers),
+                limits=httpx.Limits(max_connections=16),
+                timeout=30
+            ) as client:
+                results = await asyncio.gather(*[fetch(t, client) for t in all_texts])
+        else:
+            results = await asyncio.gather(*[fetch(t, None) for t in all_texts])
+
+        # gather() keeps the book order of all_texts
+        corpus = [doc for documents in results for doc in documents]
+        self._save_corpus(corpus, save_path)
         return corpus
 
+    def _save_corpus(self, corpus: List[Dict], save_path: str):
+        """Write the corpus to an NDJSON file (read back with load_corpus)"""
+        with open(save_path, 'wb') as f:
+            self._write_documents(f, corpus)
+
+        print(f"\nSaved {len(corpus)} documents to {save_path}")
+
+    def _write_documents(self, f, documents: Iterable[Dict]):
+        """Append documents to an open binary file, one JSON object per line"""
+        f.writelines(dump_ndjson_line(doc) for doc in documents)
+
     def _process_text_data(self, title: str, data: Dict) -> List[Dict]:
         """Process raw text data into documents"""
         documents = []
@@ -183,40 +370,38 @@ class SefariaFetcher:
         return documents
 
     def _flatten_text(self, title: str, ref: str, hebrew, english, depth: int = 0) -> List[Dict]:
-        """Flatten nested text structures into documents"""
+        """Flatten nested text structures into documents (iterative, depth-first)"""
         documents = []
+        # Children are pushed in reverse so they are popped in document order
+        stack = [(ref, hebrew, english, depth)]
+
+        while stack:
+            ref, hebrew, english, depth = stack.pop()
+            sep = ':' if depth == 0 else '.'
 
-        if isinstance(hebrew, str) and isinstance(english, str):
-            # Base case: single text segment
-            if hebrew.strip() or english.strip():
-                documents.append({
-                    'title': title,
-                    'ref': ref,
-                    'hebrew': hebrew.strip(),
-                    'english': english.strip(),
-                    'combined': f"{hebrew}\n\n{english}".strip()
-                })
-        elif isinstance(hebrew, list) and isinstance(english, list):
-            # Recursive case: nested structure
-            for i, (he_item, en_item) in enumerate(zip(hebrew, english), 1):
-                sub_ref = f"{ref}:{i}" if depth == 0 else f"{ref}.{i}"
-                sub_docs = self._flatten_text(title, sub_ref, he_item, en_item, depth + 1)
-                documents.extend(sub_docs)
-        elif isinstance(hebrew, list):
-            # Only Hebrew available
-            for i, he_item in enumerate(hebrew, 1):
-                sub_ref = f"{ref}:{i}" if depth == 0 else f"{ref}.{i}"
-                if isinstance(he_item, str) and he_item.strip():
+            if isinstance(hebrew, str) and isinstance(english, str):
+                # Leaf: single text segment
+                if hebrew.strip() or english.strip():
                     documents.append({
                         'title': title,
-                        'ref': sub_ref,
-                        'hebrew': he_item.strip(),
-                        'english': '',
-                        'combined': he_item.strip()
+                        'ref': ref,
+                        'hebrew': hebrew.strip(),
+                        'english': english.strip(),
+                        'combined': f"{hebrew}\n\n{english}".strip()
                     })
-                elif isinstance(he_item, list):
-                    sub_docs = self._flatten_text(title, sub_ref, he_item, [], depth + 1)
-                    documents.extend(sub_docs)
+            elif isinstance(hebrew, list) and isinstance(english, list):
+                # Nested structure
+                pairs = list(enumerate(zip(hebrew, english), 1))
+                for i, (he_item, en_item) in reversed(pairs):
+                    stack.append((f"{ref}{sep}{i}", he_item, en_item, depth + 1))
+            elif isinstance(hebrew, list):
+                # Only Hebrew available: strings become leaves, lists recurse
+                for i in range(len(hebrew), 0, -1):
+                    he_item = hebrew[i - 1]
+                    if isinstance(he_item, str):
+                        stack.append((f"{ref}{sep}{i}", he_item, '', depth + 1))
+                    elif isinstance(he_item, list):
+                        stack.append((f"{ref}{sep}{i}", he_item, [], depth + 1))
 
         return documents
 
@@ -0,0 +1,121 @@
+"""
+Semantic Cache
+In-process cache of retrieval results keyed by LSH over query embeddings,
+so paraphrased queries skip the ANN search.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+import numpy as np
+
+
+class SemanticCache:
+    """
+    LRU cache keyed by random-projection LSH of query embeddings.
+
+    A lookup hashes the query vector into a bucket and returns the payload of
+    the closest stored query in that bucket if its cosine similarity is at
+    least `threshold`.
+    """
+
+    def __init__(
+        self,
+        nbits: int = 8,
+        threshold: float = 0.95,
+        max_entries: int = 512,
+        seed: int = 0
+    ):
+        self.nbits = nbits
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.seed = seed
+
+        # Projections are created on first use, once the dimension is known
+        self._projections: Optional[np.ndarray] = None
+        self._buckets: "OrderedDict[Tuple[Optional[Hashable], bytes], List[Tuple[np.ndarray, Any]]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _normalize(self, query_vec) -> np.ndarray:
+        vec = np.asarray(query_vec, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _key(self, vec: np.ndarray, namespace: Optional[Hashable]) -> Tuple[Optional[Hashable], bytes]:
+        if self._projections is None or self._projections.shape[1] != vec.shape[0]:
+            self._projections = np.random.RandomState(self.seed).randn(
+                self.nbits, vec.shape[0]
+            ).astype(np.float32)
+            self._clear()
+        bits = np.packbits(self._projections @ vec > 0)
+        return namespace, bits.tobytes()
+
+    def get(self, query_vec, namespace: Optional[Hashable] = None) -> Optional[Any]:
+        """
+        Look up a cached payload for a query embedding
+
+        Args:
+            query_vec: Query embedding
+            namespace: Optional extra key, e.g. (reference, corpus version);
+                entries only match within it
+
+        Returns:
+            Cached payload or None on miss
+        """
+        vec = self._normalize(query_vec)
+
+        with self._lock:
+            key = self._key(vec, namespace)
+            bucket = self._buckets.get(key)
+            if bucket:
+                best_score, best_payload = -1.0, None
+                for cached_vec, payload in bucket:
+                    score = float(cached_vec @ vec)
+                    if score > best_score:
+                        best_score, best_payload = score, payload
+                if best_score >= self.threshold:
+                    self._buckets.move_to_end(key)
+                    self.hits += 1
+                    return best_payload
+
+            self.misses += 1
+            return None
+
+    def put(self, query_vec, payload: Any, namespace: Optional[Hashable] = None):
+        """Store a payload for a query embedding"""
+        vec = self._normalize(query_vec)
+
+        with self._lock:
+            key = self._key(vec, namespace)
+            self._buckets.setdefault(key, []).append((vec, payload))
+            self._buckets.move_to_end(key)
+            self._size += 1
+
+            # Evict least recently used buckets
+            while self._size > self.max_entries and self._buckets:
+                _, evicted = self._buckets.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._buckets.clear()
+        self._size = 0
+
+    def get_statistics(self) -> Dict:
+        """Get cache hit/miss statistics"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': self._size,
+            'buckets': len(self._buckets)
+        }
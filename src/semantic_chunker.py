@@ -3,9 +3,53 @@ Semantic Chunker for Breslov Texts
 Implements intelligent chunking with overlap for better RAG performance
 """
 
+import os
 import re
-from typing import List, Dict, Tuple
-import json
+import time
+import threading
+from collections import OrderedDict
+from itertools import chain, islice
+from multiprocessing import Pool
+from operator import itemgetter
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
+
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+try:
+    from .sefaria_fetcher import iter_corpus, dump_ndjson_line
+except ImportError:
+    from sefaria_fetcher import iter_corpus, dump_ndjson_line
+
+
+# Sentence boundaries: Hebrew/English terminal punctuation, or paragraph breaks
+_SENT_RE = re.compile(r'(?<=[.!?:。])\s+|(?<=\n\n)')
+# Paragraph breaks: double newlines or significant breaks
+_PARA_RE = re.compile(r'\n\s*\n|\r\n\s*\r\n')
+
+
+def _strip_tags(text: str) -> str:
+    """Replace each HTML tag with a space (same matches as r'<[^>]+>')"""
+    parts = []
+    start = pos = 0
+    while True:
+        lt = text.find('<', pos)
+        if lt < 0:
+            break
+        gt = text.find('>', lt + 1)
+        if gt < 0:
+            break
+        if gt == lt + 1:
+            # '<>' is not a tag
+            pos = gt
+            continue
+        parts.append(text[start:lt])
+        start = pos = gt + 1
+    parts.append(text[start:])
+    return ' '.join(parts)
 
 
 class SemanticChunker:
@@ -16,6 +60,10 @@ class SemanticChunker:
     - Optimal chunk sizes for embeddings
     """
 
+    # Corpora at least this large are chunked in worker processes, this
+    # many documents at a time
+    PARALLEL_MIN_DOCUMENTS = 2000
+
     def __init__(
         self,
         target_chunk_size: int = 1000,  # Target chars per chunk
@@ -30,17 +78,18 @@ class SemanticChunker:
 
     def _split_into_sentences(self, text: str) -> List[str]:
         """Split text into sentences, handling Hebrew and English"""
-        # Split on sentence boundaries
         # Hebrew: ends with period, colon, or special marks
-        # Also handle paragraph breaks
-        pattern = r'(?<=[.!?:。])\s+|(?<=\n\n)'
-        sentences = re.split(pattern, text)
+        sentences = _SENT_RE.split(text)
         return [s.strip() for s in sentences if s.strip()]
 
     def _split_into_paragraphs(self, text: str) -> List[str]:
         """Split text into paragraphs"""
-        # Split on double newlines or significant breaks
-        paragraphs = re.split(r'\n\s*\n|\r\n\s*\r\n', text)
+        # Every break contains a newline; chunk_document passes text whose
+        # whitespace is already folded, so this is the common case
+        if '\n' not in text:
+            text = text.strip()
+            return [text] if text else []
+        paragraphs = _PARA_RE.split(text)
         return [p.strip() for p in paragraphs if p.strip()]
 
     def _create_chunks_with_overlap(
@@ -67,11 +116,12 @@ class SemanticChunker:
 
                 # Start new chunk with overlap
                 if overlap and len(current_chunk) > 1:
-                    # Keep last portion for overlap
-                    overlap_text = ' '.join(current_chunk[-2:])
-                    if len(overlap_text) <= self.overlap_size * 2:
+                    # Keep last portion for overlap (length of the joined
+                    # pair, without building it)
+                    overlap_length = len(current_chunk[-2]) + 1 + len(current_chunk[-1])
+                    if overlap_length <= self.overlap_size * 2:
                         current_chunk = current_chunk[-2:]
-                        current_length = len(overlap_text)
+                        current_length = overlap_length
                     else:
                         current_chunk = [current_chunk[-1]]
                         current_length = len(current_chunk[0])
@@ -131,8 +181,7 @@ class SemanticChunker:
         combined = '\n\n'.join(combined_parts)
 
         # Clean HTML artifacts
-        combined = re.sub(r'<[^>]+>', ' ', combined)
-        combined = re.sub(r'\s+', ' ', combined).strip()
+        combined = ' '.join(_strip_tags(combined).split())
 
         # If document is small enough, keep as is
         if len(combined) <= self.max_chunk_size:
@@ -178,23 +227,37 @@ class SemanticChunker:
 
         return chunks
 
-    def chunk_corpus(self, corpus: List[Dict]) -> List[Dict]:
+    def chunk_corpus(self, corpus: Iterable[Dict], processes: Optional[int] = None) -> Iterator[Dict]:
         """
         Chunk entire corpus
 
+        Chunks are yielded as they are made, so a streamed corpus is never
+        held in memory. Documents are chunked independently, so large
+        corpora are split across worker processes (chunks keep corpus order).
+
         Args:
-            corpus: List of documents
+            corpus: Documents (list or any iterable)
+            processes: Worker processes (default: CPU count, 1 = no workers)
 
-        Returns:
-            List of chunked documents
+        Yields:
+            Chunked documents
         """
-        chunked_corpus = []
+        processes = processes or os.cpu_count() or 1
+        documents = iter(corpus)
+        window = list(islice(documents, self.PARALLEL_MIN_DOCUMENTS))
 
-        for doc in corpus:
-            chunks = self.chunk_document(doc)
-            chunked_corpus.extend(chunks)
+        if processes > 1 and len(window) == self.PARALLEL_MIN_DOCUMENTS:
+            chunksize = max(1, len(window) // (processes * 8))
+            with Pool(processes=processes) as pool:
+                # Bounded windows: imap alone would read the whole corpus ahead
+                while window:
+                    for chunks in pool.imap(self.chunk_document, window, chunksize=chunksize):
+                        yield from chunks
+                    window = list(islice(documents, self.PARALLEL_MIN_DOCUMENTS))
+            return
 
-        return chunked_corpus
+        for doc in chain(window, documents):
+            yield from self.chunk_document(doc)
 
 
 class HybridRetriever:
@@ -205,9 +268,20 @@ class HybridRetriever:
     - Metadata filtering
     """
 
+    # Query words from which a one-pass Aho-Corasick scan beats per-word
+    # substring checks (shorter queries are faster with `in`)
+    AHOCORASICK_MIN_WORDS = 32
+
+    # Recent searches are reused for CACHE_TTL seconds
+    CACHE_SIZE = 256
+    CACHE_TTL = 60.0
+
     def __init__(self, embeddings_manager):
         self.embeddings = embeddings_manager
 
+        self._cache: "OrderedDict[Tuple, Tuple[float, List[Dict]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
     def search(
         self,
         query: str,
@@ -227,6 +301,14 @@ class HybridRetriever:
         Returns:
             Ranked list of relevant documents
         """
+        key = (query, n_results, min_score, book_filter)
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None and now - cached[0] < self.CACHE_TTL:
+                self._cache.move_to_end(key)
+                return [dict(r) for r in cached[1]]
+
         # Get more results for reranking
         initial_results = self.embeddings.search(query, n_results=n_results * 2)
 
@@ -245,26 +327,48 @@ class HybridRetriever:
 
         # Keyword boost: boost results that contain query keywords
         query_words = set(query.lower().split())
+        automaton = None
+        if AHOCORASICK_AVAILABLE and len(query_words) >= self.AHOCORASICK_MIN_WORDS:
+            # Find all query words in one pass over each text
+            automaton = ahocorasick.Automaton()
+            for word in query_words:
+                automaton.add_word(word, word)
+            automaton.make_automaton()
+
         for result in filtered:
             text = result.get('text', '').lower()
-            keyword_matches = sum(1 for word in query_words if word in text)
+            if automaton is not None:
+                keyword_matches = len({word for _, word in automaton.iter(text)})
+            else:
+                keyword_matches = sum(1 for word in query_words if word in text)
             # Boost score based on keyword matches
             result['relevance_score'] *= (1 + 0.1 * keyword_matches)
 
-        # Sort by adjusted score
-        filtered.sort(key=lambda x: x.get('relevance_score', 0), reverse=True)
+        # Sort by adjusted score (every result has one after the boost)
+        filtered.sort(key=itemgetter('relevance_score'), reverse=True)
+        results = filtered[:n_results]
+
+        with self._cache_lock:
+            self._cache[key] = (now, results)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
 
-        return filtered[:n_results]
+        # Copies, so callers cannot alter the cached results
+        return [dict(r) for r in results]
 
 
-def process_corpus_with_chunking(input_file: str, output_file: str):
-    """Process corpus with semantic chunking"""
-    print("Loading corpus...")
-    with open(input_file, 'r', encoding='utf-8') as f:
-        corpus = json.load(f)
+def write_chunked_corpus(input_file: str, output_file: str) -> int:
+    """
+    Chunk a corpus file into an NDJSON file (one chunk per line)
 
-    print(f"Original documents: {len(corpus)}")
+    Documents are read, chunked and written one at a time, so neither the
+    corpus nor the chunks are held in memory; read the output back with
+    load_corpus or iter_corpus.
 
+    Returns:
+        Number of chunks written
+    """
     chunker = SemanticChunker(
         target_chunk_size=1000,
         max_chunk_size=1500,
@@ -272,27 +376,42 @@ def process_corpus_with_chunking(input_file: str, output_file: str):
     )
 
     print("Chunking corpus...")
-    chunked = chunker.chunk_corpus(corpus)
-
-    print(f"After chunking: {len(chunked)} chunks")
-
-    # Save
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(chunked, f, ensure_ascii=False, indent=2)
-
+    documents = 0
+    count = 0
+    total_length = 0
+    min_length = max_length = 0
+
+    def corpus() -> Iterator[Dict]:
+        nonlocal documents
+        for doc in iter_corpus(input_file):
+            documents += 1
+            yield doc
+
+    with open(output_file, 'wb') as f:
+        for chunk in chunker.chunk_corpus(corpus()):
+            f.write(dump_ndjson_line(chunk))
+
+            # Statistics
+            length = len(chunk.get('combined', ''))
+            min_length = min(min_length, length) if count else length
+            max_length = max(max_length, length)
+            total_length += length
+            count += 1
+
+    print(f"Original documents: {documents}")
+    print(f"After chunking: {count} chunks")
     print(f"Saved to {output_file}")
 
-    # Statistics
-    lengths = [len(c.get('combined', '')) for c in chunked]
-    print(f"\nChunk statistics:")
-    print(f"  Average length: {sum(lengths)/len(lengths):.0f} chars")
-    print(f"  Min: {min(lengths)}, Max: {max(lengths)}")
+    if count:
+        print(f"\nChunk statistics:")
+        print(f"  Average length: {total_length/count:.0f} chars")
+        print(f"  Min: {min_length}, Max: {max_length}")
 
-    return chunked
+    return count
 
 
 if __name__ == "__main__":
-    process_corpus_with_chunking(
+    write_chunked_corpus(
         'data/breslov_complete.json',
-        'data/breslov_chunked.json'
+        'data/breslov_chunked.ndjson'
     )
@@ -7,18 +7,34 @@ Supabase instead of local FAISS.
 """
 
 import os
-from typing import List, Dict, Optional
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Sequence
 from dotenv import load_dotenv
 
 load_dotenv("config/.env")
 
 
+def _like_literal(value: str) -> str:
+    """Escape LIKE wildcards, so ilike matches the value case-insensitively but literally"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
 class SupabaseEmbeddingsManager:
     """
     Manages embeddings in Supabase with pgvector.
     Drop-in replacement for EmbeddingsManager.
     """
 
+    # Texts per embed_content call when adding documents
+    EMBED_BATCH_SIZE = 100
+    # Query embeddings kept in memory (repeated queries skip the API call)
+    QUERY_CACHE_SIZE = 1024
+    # References whose exact-match chunk count is remembered
+    REF_COUNT_CACHE_SIZE = 4096
+
     def __init__(
         self,
         api_key: str,  # Gemini API key for generating embeddings
@@ -50,19 +66,65 @@ class SupabaseEmbeddingsManager:
         self._documents_cache = []
         self._metadatas_cache = []
 
+        self._query_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        # lower(ref) -> number of chunks with that exact reference, learned
+        # from lookups that returned fewer rows than their limit
+        self._ref_counts: "OrderedDict[str, int]" = OrderedDict()
+        self._ref_counts_lock = threading.Lock()
+
     def _generate_embedding(self, text: str) -> List[float]:
-        """Generate embedding for a single text"""
+        """Generate embedding for a single text (LRU-cached in memory)"""
+        key = hashlib.sha256(f"{self.embedding_model}\0{text}".encode('utf-8')).hexdigest()
+        with self._query_cache_lock:
+            cached = self._query_cache.get(key)
+            if cached is not None:
+                self._query_cache.move_to_end(key)
+                return cached
+
         result = self.gemini_client.models.embed_content(
             model=self.embedding_model,
             contents=text
         )
-        return result.embeddings[0].values
+        embedding = result.embeddings[0].values
+
+        with self._query_cache_lock:
+            self._query_cache[key] = embedding
+            if len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return embedding
+
+    def _remember_ref_count(self, ref: str, count: int):
+        """Record how many chunks carry an exact reference (bounded LRU)"""
+        with self._ref_counts_lock:
+            self._ref_counts[ref.lower()] = count
+            self._ref_counts.move_to_end(ref.lower())
+            if len(self._ref_counts) > self.REF_COUNT_CACHE_SIZE:
+                self._ref_counts.popitem(last=False)
+
+    def _generate_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for several texts in one API call"""
+        result = self.gemini_client.models.embed_content(
+            model=self.embedding_model,
+            contents=texts
+        )
+        return [e.values for e in result.embeddings]
+
+    def get_embedding(self, text: str) -> List[float]:
+        """Compatibility method - embedding for a single text, [] on error"""
+        try:
+            return self._generate_embedding(text)
+        except Exception as e:
+            print(f"Error getting embedding: {e}")
+            return []
 
     def search(
         self,
         query: str,
         n_results: int = 5,
-        threshold: float = 0.5
+        threshold: float = 0.5,
+        query_embedding: Optional[List[float]] = None,
+        subset: Optional[Sequence[int]] = None
     ) -> List[Dict]:
         """
         Search for similar documents using Supabase pgvector.
@@ -71,12 +133,18 @@ class SupabaseEmbeddingsManager:
             query: Search query text
             n_results: Number of results to return
             threshold: Minimum similarity threshold
+            query_embedding: Precomputed query embedding (skips the embedding call)
+            subset: Accepted for EmbeddingsManager compatibility and ignored
+                (the rows have no local document indices)
 
         Returns:
             List of matching documents with metadata and scores
         """
         # Generate query embedding
-        query_embedding = self._generate_embedding(query)
+        if query_embedding is None:
+            query_embedding = self._generate_embedding(query)
+        else:
+            query_embedding = list(query_embedding)
 
         # Call Supabase RPC function
         try:
@@ -130,6 +198,32 @@ class SupabaseEmbeddingsManager:
         Returns:
             List of matching documents
         """
+        if ref and self._ref_counts.get(ref.lower(), n_results) >= n_results:
+            # Enough exact reference matches fill the results on their own,
+            # without the embedding round-trip (skipped for references known
+            # to have fewer chunks than requested)
+            try:
+                exact = self.supabase.table(self.table_name).select(
+                    "id, title, ref, combined"
+                ).ilike("ref", _like_literal(ref)).order("chunk_index").limit(n_results).execute()
+                if len(exact.data) >= n_results:
+                    return [
+                        {
+                            "id": str(row.get("id")),
+                            "text": row.get("combined", ""),
+                            "metadata": {
+                                "title": row.get("title", ""),
+                                "ref": row.get("ref", ""),
+                            },
+                            "relevance_score": 1.0,
+                            "match_type": "exact_reference"
+                        }
+                        for row in exact.data
+                    ]
+                self._remember_ref_count(ref, len(exact.data))
+            except Exception as e:
+                print(f"Supabase reference lookup error: {e}")
+
         # Generate query embedding
         query_embedding = self._generate_embedding(query)
 
@@ -191,27 +285,60 @@ class SupabaseEmbeddingsManager:
             ids: Optional list of unique IDs
 
         Returns:
-            True if successful
+            True if successful (False if any batch failed to embed or upsert;
+            the other batches are still added)
         """
-        records = []
-
-        for i, (doc, meta) in enumerate(zip(documents, metadatas)):
-            # Generate embedding
-            embedding = self._generate_embedding(doc)
-
-            record = {
-                "title": meta.get("title", "Unknown"),
-                "ref": meta.get("ref", f"doc_{i}"),
-                "chunk_id": ids[i] if ids else meta.get("chunk_id", f"chunk_{i}"),
-                "hebrew": meta.get("hebrew", ""),
-                "english": meta.get("english", ""),
-                "combined": doc,
-                "embedding": embedding,
-                "chunk_index": meta.get("chunk_index", 0),
-                "total_chunks": meta.get("total_chunks", 1),
-            }
-            records.append(record)
-
+        # Identical texts are embedded once
+        by_digest = {}
+        embedded_all = True
+
+        # Each batch is upserted in the background while the next one is
+        # embedded, so the Supabase and Gemini round-trips overlap
+        uploads = []
+        with ThreadPoolExecutor(max_workers=1) as uploader:
+            pairs = list(zip(documents, metadatas))
+            for start in range(0, len(pairs), self.EMBED_BATCH_SIZE):
+                batch = pairs[start:start + self.EMBED_BATCH_SIZE]
+                digests = [hashlib.sha256(doc.encode('utf-8')).digest() for doc, _ in batch]
+
+                # One embedding call per batch instead of one per document
+                new_texts = {}
+                for digest, (doc, _) in zip(digests, batch):
+                    if digest not in by_digest:
+                        new_texts.setdefault(digest, doc)
+                if new_texts:
+                    try:
+                        embeddings = self._generate_embeddings_batch(list(new_texts.values()))
+                    except Exception as e:
+                        # Skip this batch, keep adding the others
+                        print(f"Error embedding documents {start}-{start + len(batch)}: {e}")
+                        embedded_all = False
+                        continue
+                    by_digest.update(zip(new_texts, embeddings))
+
+                records = []
+                for i, (digest, (doc, meta)) in enumerate(zip(digests, batch), start):
+                    records.append({
+                        "title": meta.get("title", "Unknown"),
+                        "ref": meta.get("ref", f"doc_{i}"),
+                        "chunk_id": ids[i] if ids else meta.get("chunk_id", f"chunk_{i}"),
+                        "hebrew": meta.get("hebrew", ""),
+                        "english": meta.get("english", ""),
+                        "combined": doc,
+                        "embedding": by_digest[digest],
+                        "chunk_index": meta.get("chunk_index", 0),
+                        "total_chunks": meta.get("total_chunks", 1),
+                    })
+                uploads.append(uploader.submit(self._upsert_records, records))
+
+        results = [upload.result() for upload in uploads]
+        # New chunks may change the per-reference counts
+        with self._ref_counts_lock:
+            self._ref_counts.clear()
+        return embedded_all and all(results)
+
+    def _upsert_records(self, records: List[Dict]) -> bool:
+        """Upsert one batch of records, False on error"""
         try:
             self.supabase.table(self.table_name).upsert(
                 records,
@@ -253,6 +380,11 @@ class SupabaseEmbeddingsManager:
         """Compatibility property - returns cached metadata"""
         return self._metadatas_cache
 
+    @property
+    def text_previews(self) -> List[str]:
+        """Compatibility property - returns cached context previews"""
+        return [doc[:1500] for doc in self._documents_cache]
+
 
 # Test
 if __name__ == "__main__":
@@ -5,16 +5,39 @@ Uses pgvector for semantic search
 
 import os
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 from supabase import create_client, Client
 from google import genai
 from tqdm import tqdm
-import time
+
+try:
+    from .sefaria_fetcher import RateLimiter
+except ImportError:
+    from sefaria_fetcher import RateLimiter
+
+
+def _throttle_delay(error: Exception) -> Optional[float]:
+    """Seconds asked for by an HTTP 429 error (0 without Retry-After), None for other errors"""
+    if 429 not in (getattr(error, 'code', None), getattr(error, 'status_code', None)):
+        return None
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After', 0))
+    except (TypeError, ValueError):
+        return 0.0
 
 
 class SupabaseVectorStore:
     """Vector store using Supabase with pgvector"""
 
+    # Concurrent embedding calls while adding documents, and their rate limit
+    EMBED_WORKERS = 8
+    EMBED_REQUESTS_PER_SECOND = 2
+    # Retries of a throttled (HTTP 429) embedding call, with doubling backoff
+    EMBED_MAX_RETRIES = 5
+
     def __init__(
         self,
         supabase_url: str,
@@ -49,15 +72,15 @@ class SupabaseVectorStore:
             hebrew TEXT,
             english TEXT,
             combined TEXT,
-            embedding vector({self.embedding_dim}),
+            embedding halfvec({self.embedding_dim}),
             created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
         );
 
         -- Create index for vector similarity search
         CREATE INDEX IF NOT EXISTS {self.table_name}_embedding_idx
         ON {self.table_name}
-        USING ivfflat (embedding vector_cosine_ops)
-        WITH (lists = 100);
+        USING hnsw (embedding halfvec_cosine_ops)
+        WITH (m = 16, ef_construction = 64);
 
         -- Create function for similarity search
         CREATE OR REPLACE FUNCTION match_{self.table_name}(
@@ -81,10 +104,10 @@ class SupabaseVectorStore:
                 ref,
                 hebrew,
                 english,
-                1 - (embedding <=> query_embedding) AS similarity
+                1 - (embedding <=> query_embedding::halfvec({self.embedding_dim})) AS similarity
             FROM {self.table_name}
-            WHERE 1 - (embedding <=> query_embedding) > match_threshold
-            ORDER BY embedding <=> query_embedding
+            WHERE 1 - (embedding <=> query_embedding::halfvec({self.embedding_dim})) > match_threshold
+            ORDER BY embedding <=> query_embedding::halfvec({self.embedding_dim})
             LIMIT match_count;
         $$;
         """
@@ -104,44 +127,79 @@ class SupabaseVectorStore:
             print(f"Error getting embedding: {e}")
             return []
 
+    def get_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+        """Get embeddings for several texts in one Gemini call ([] for each on error)"""
+        backoff = 1.0
+        for attempt in range(self.EMBED_MAX_RETRIES + 1):
+            try:
+                result = self.gemini.models.embed_content(
+                    model="gemini-embedding-001",
+                    contents=[text[:8000] for text in texts]
+                )
+                return [e.values for e in result.embeddings]
+            except Exception as e:
+                # Only wait when the API says it is throttling us
+                delay = _throttle_delay(e)
+                if delay is not None and attempt < self.EMBED_MAX_RETRIES:
+                    time.sleep(delay or backoff)
+                    backoff *= 2
+                    continue
+                print(f"Error getting embeddings: {e}")
+                return [[] for _ in texts]
+
     def add_documents(self, documents: List[Dict], batch_size: int = 50):
         """Add documents to Supabase with embeddings"""
         print(f"Adding {len(documents)} documents to Supabase...")
 
-        for i in tqdm(range(0, len(documents), batch_size)):
-            batch = documents[i:i + batch_size]
-            records = []
-
-            for doc in batch:
+        batches = []
+        for i in range(0, len(documents), batch_size):
+            batch = []
+            texts = []
+            for doc in documents[i:i + batch_size]:
                 text = doc.get('combined', '') or doc.get('english', '') or doc.get('hebrew', '')
-                if not text:
-                    continue
-
-                # Get embedding
-                embedding = self.get_embedding(text)
-                if not embedding:
-                    continue
-
-                records.append({
-                    'title': doc.get('title', ''),
-                    'ref': doc.get('ref', ''),
-                    'hebrew': doc.get('hebrew', '')[:10000],
-                    'english': doc.get('english', '')[:10000],
-                    'combined': text[:15000],
-                    'embedding': embedding
-                })
-
-            if records:
-                try:
-                    # Upsert to handle duplicates
-                    self.supabase.table(self.table_name).upsert(
-                        records,
-                        on_conflict='ref'
-                    ).execute()
-                except Exception as e:
-                    print(f"Error inserting batch: {e}")
-
-            time.sleep(1)  # Rate limiting
+                if text:
+                    batch.append(doc)
+                    texts.append(text)
+            batches.append((batch, texts))
+
+        # Embedding calls overlap in a thread pool, throttled by a token
+        # bucket instead of a fixed sleep after every batch
+        limiter = RateLimiter(self.EMBED_REQUESTS_PER_SECOND, self.EMBED_WORKERS)
+
+        def embed(texts: List[str]) -> List[List[float]]:
+            if not texts:
+                return []
+            limiter.acquire()
+            return self.get_embeddings_batch(texts)
+
+        with ThreadPoolExecutor(max_workers=self.EMBED_WORKERS) as executor:
+            all_embeddings = executor.map(embed, [texts for _, texts in batches])
+
+            for (batch, texts), embeddings in tqdm(zip(batches, all_embeddings), total=len(batches)):
+                records = []
+
+                for doc, text, embedding in zip(batch, texts, embeddings):
+                    if not embedding:
+                        continue
+
+                    records.append({
+                        'title': doc.get('title', ''),
+                        'ref': doc.get('ref', ''),
+                        'hebrew': doc.get('hebrew', '')[:10000],
+                        'english': doc.get('english', '')[:10000],
+                        'combined': text[:15000],
+                        'embedding': embedding
+                    })
+
+                if records:
+                    try:
+                        # Upsert to handle duplicates
+                        self.supabase.table(self.table_name).upsert(
+                            records,
+                            on_conflict='ref'
+                        ).execute()
+                    except Exception as e:
+                        print(f"Error inserting batch: {e}")
 
         print("Done adding documents!")
 
@@ -208,15 +266,15 @@ CREATE TABLE IF NOT EXISTS breslov_documents (
     hebrew TEXT,
     english TEXT,
     combined TEXT,
-    embedding vector(3072),
+    embedding halfvec(3072),
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
 -- Create index for fast similarity search
 CREATE INDEX IF NOT EXISTS breslov_documents_embedding_idx
 ON breslov_documents
-USING ivfflat (embedding vector_cosine_ops)
-WITH (lists = 100);
+USING hnsw (embedding halfvec_cosine_ops)
+WITH (m = 16, ef_construction = 64);
 
 -- Create similarity search function
 CREATE OR REPLACE FUNCTION match_breslov_documents(
@@ -240,10 +298,10 @@ AS $$
         ref,
         hebrew,
         english,
-        1 - (embedding <=> query_embedding) AS similarity
+        1 - (embedding <=> query_embedding::halfvec(3072)) AS similarity
     FROM breslov_documents
-    WHERE 1 - (embedding <=> query_embedding) > match_threshold
-    ORDER BY embedding <=> query_embedding
+    WHERE 1 - (embedding <=> query_embedding::halfvec(3072)) > match_threshold
+    ORDER BY embedding <=> query_embedding::halfvec(3072)
     LIMIT match_count;
 $$;
 """
@@ -6,6 +6,9 @@ Tests retrieval quality across different Breslov books
 import os
 import sys
 import json
+import asyncio
+from collections import deque
+from typing import List
 from dotenv import load_dotenv
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -53,15 +56,24 @@ def test_retrieval_quality(embeddings: EmbeddingsManager, verbose: bool = True):
 
     results = {}
 
+    # Embed every test query in one API call (cached on disk, so re-runs make none)
+    # and search them all in one index call
+    all_queries = [query for queries in TEST_QUERIES.values() for query in queries]
+    all_results = dict(zip(all_queries, embeddings.search_batch(all_queries, n_results=5)))
+
     for book, queries in TEST_QUERIES.items():
-        print(f"\n--- Testing: {book} ---")
+        # Lines for this book are written in one call, not one print per line
+        out: List[str] = [f"\n--- Testing: {book} ---"]
         book_scores = []
 
+        # Book match check (flexible matching on any word of the book name)
+        book_keywords = tuple(book.lower().split())
+
         for query in queries:
-            search_results = embeddings.search(query, n_results=5)
+            search_results = all_results[query]
 
             if not search_results:
-                print(f"  [FAIL] No results for: {query[:50]}...")
+                out.append(f"  [FAIL] No results for: {query[:50]}...")
                 book_scores.append(0)
                 continue
 
@@ -70,22 +82,20 @@ def test_retrieval_quality(embeddings: EmbeddingsManager, verbose: bool = True):
             top_title = top_result['metadata'].get('title', '')
             top_score = top_result.get('relevance_score', 0)
 
-            # Book match check (flexible matching)
-            book_keywords = book.lower().split()
             title_lower = top_title.lower()
             is_match = any(kw in title_lower for kw in book_keywords)
 
             if is_match:
-                print(f"  [OK] {query[:50]}...")
-                print(f"       -> {top_title} (score: {top_score:.3f})")
+                out.append(f"  [OK] {query[:50]}...")
+                out.append(f"       -> {top_title} (score: {top_score:.3f})")
                 book_scores.append(top_score)
             else:
-                print(f"  [WARN] {query[:50]}...")
-                print(f"       -> Got: {top_title} (expected: {book})")
+                out.append(f"  [WARN] {query[:50]}...")
+                out.append(f"       -> Got: {top_title} (expected: {book})")
                 book_scores.append(top_score * 0.5)  # Partial credit
 
             if verbose:
-                print(f"       Text preview: {search_results[0]['text'][:100]}...")
+                out.append(f"       Text preview: {search_results[0]['text'][:100]}...")
 
         # Calculate book average
         if book_scores:
@@ -95,12 +105,18 @@ def test_retrieval_quality(embeddings: EmbeddingsManager, verbose: bool = True):
                 'queries_tested': len(queries),
                 'scores': book_scores
             }
-            print(f"  Average score for {book}: {avg_score:.3f}")
+            out.append(f"  Average score for {book}: {avg_score:.3f}")
+
+        sys.stdout.write('\n'.join(out) + '\n')
 
     return results
 
 
-def test_generation_quality(engine: GUEZIRagEngine):
+# Generation test calls in flight at once (keeps within the Gemini RPM limit)
+GENERATION_CONCURRENCY = 3
+
+
+async def test_generation_quality(engine: GUEZIRagEngine):
     """Test that the model doesn't hallucinate"""
     print("\n" + "="*70)
     print("GENERATION QUALITY TEST (Hallucination Check)")
@@ -121,20 +137,31 @@ def test_generation_quality(engine: GUEZIRagEngine):
         }
     ]
 
-    for i, test in enumerate(test_cases, 1):
-        print(f"\n--- Test {i}: {test['check']} ---")
-        print(f"Query: {test['query']}")
-
-        response = engine.generate_response(test['query'], language='en')
-
-        print(f"Sources found: {len(response.get('sources', []))}")
-        if response.get('sources'):
-            for s in response['sources'][:2]:
-                print(f"  - {s.get('title', '')} / {s.get('ref', '')}")
-
-        print(f"\nResponse preview:")
-        print(f"  {response['response'][:300]}...")
-        print()
+    semaphore = asyncio.Semaphore(GENERATION_CONCURRENCY)
+
+    async def generate(query: str) -> dict:
+        # Each case gets its own history so concurrent cases stay independent
+        async with semaphore:
+            return await engine.agenerate_response(
+                query, language='en', history=deque(maxlen=engine.HISTORY_MAXLEN)
+            )
+
+    responses = await asyncio.gather(*(generate(test['query']) for test in test_cases))
+
+    for i, (test, response) in enumerate(zip(test_cases, responses), 1):
+        out = [
+            f"\n--- Test {i}: {test['check']} ---",
+            f"Query: {test['query']}",
+            f"Sources found: {len(response.get('sources', []))}"
+        ]
+        out.extend(
+            f"  - {s.get('title', '')} / {s.get('ref', '')}"
+            for s in (response.get('sources') or [])[:2]
+        )
+        out.append("\nResponse preview:")
+        out.append(f"  {response['response'][:300]}...")
+        out.append("")
+        sys.stdout.write('\n'.join(out) + '\n')
 
 
 def run_full_test():
@@ -151,7 +178,8 @@ def run_full_test():
     embeddings = EmbeddingsManager(
         api_key=api_key,
         persist_dir="./data/faiss_db",
-        collection_name="breslov_chunked"
+        collection_name="breslov_chunked",
+        embed_cache_dir="./data/embed_cache"  # same test queries on every run
     )
 
     stats = embeddings.get_collection_stats()
@@ -169,7 +197,7 @@ def run_full_test():
     engine = GUEZIRagEngine(api_key, embeddings_manager=embeddings)
 
     # Test generation
-    test_generation_quality(engine)
+    asyncio.run(test_generation_quality(engine))
 
     # Summary
     print("\n" + "="*70)
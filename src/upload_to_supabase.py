@@ -3,20 +3,57 @@ Upload FAISS embeddings to Supabase
 Run this script to migrate local FAISS data to Supabase cloud database.
 
 Usage:
-    python src/upload_to_supabase.py
+    python src/upload_to_supabase.py [--yes] [--mode pgrest|copy]
+        [--collection NAME] [--batch-size N] [--concurrency N]
+        [--shard K --num-shards N]
+
+Set UPLOAD_MODE=copy or pass --mode copy (and SUPABASE_DB_URL to the
+Postgres connection string) to bulk load with COPY over a direct psycopg
+connection instead of PostgREST upserts.
+
+--shard/--num-shards upload one contiguous slice of the index, so several
+uploaders can run in parallel (upserts on chunk_id make overlaps safe).
 """
 
 import os
 import sys
 import json
+import argparse
+import time
 import pickle
-from typing import List, Dict
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from typing import List, Dict, Iterable, Iterator, Optional
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+# Optional fast JSON serializer: embeddings are sent straight from float32
+# arrays (about half the JSON of Python float lists)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Optional columnar metadata: read lazily in batches instead of unpickling
+# every document and metadata dict up front
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
 # Load environment variables
 load_dotenv("config/.env")
 
 # Supabase client
+import httpx
+from postgrest.exceptions import APIError
 from supabase import create_client, Client
 
 # Configuration
@@ -25,24 +62,161 @@ SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")  # Use service key for insert
 FAISS_DB_PATH = "./data/faiss_db"
 CHUNKED_DATA_PATH = "./data/breslov_chunked.json"
 TABLE_NAME = "breslov_documents"
-BATCH_SIZE = 50  # Insert in batches to avoid timeouts
+# Rows per upsert: a 3072-dim embedding is 35-60 KB of JSON, so 100 rows is
+# at most ~6 MB per request (batches the server rejects as too large are split)
+BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", "100"))
+UPLOAD_WORKERS = 8  # Batches upserted concurrently
+UPLOAD_MAX_RETRIES = 5  # Attempts per request on throttling/server errors
+# (connect, read) seconds per request: a stalled request is retried instead
+# of hanging its worker
+UPLOAD_TIMEOUT = (10, 120)
+# HTTP statuses worth retrying, and those where the server rejected rows
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+ROW_ERROR_STATUSES = {400, 409, 413, 422}
+# Postgres SQLSTATE classes (supabase-py APIError codes) worth retrying:
+# transaction rollback (deadlock, serialization) and insufficient resources
+RETRY_SQLSTATE_CLASSES = {"40", "53"}
+# ... and those where rows were rejected: data exception, integrity violation
+ROW_ERROR_SQLSTATE_CLASSES = {"22", "23"}
+# "pgrest" (batched upserts over HTTP) or "copy" (COPY over psycopg)
+UPLOAD_MODE = os.getenv("UPLOAD_MODE", "pgrest")
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+COPY_COLUMNS = (
+    "title", "ref", "chunk_id", "hebrew", "english", "combined",
+    "embedding", "chunk_index", "total_chunks",
+)
+# Columns of <collection>_metadata.parquet (the records without embeddings)
+METADATA_SCHEMA = pa.schema([
+    ("title", pa.string()),
+    ("ref", pa.string()),
+    ("chunk_id", pa.string()),
+    ("hebrew", pa.string()),
+    ("english", pa.string()),
+    ("combined", pa.string()),
+    ("chunk_index", pa.int64()),
+    ("total_chunks", pa.int64()),
+]) if PYARROW_AVAILABLE else None
+
+
+def _http_status(error: Exception) -> Optional[int]:
+    """HTTP status of a failed request, if known"""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if isinstance(status, int):
+        return status
+    # supabase-py only puts the HTTP status in APIError.code when the
+    # response body was not a PostgREST error (e.g. from the API gateway)
+    if isinstance(error, APIError) and isinstance(error.code, int):
+        return error.code
+    return None
+
+
+def _postgrest_code(error: Exception) -> Optional[str]:
+    """PostgREST ('PGRST...') or Postgres SQLSTATE code of a supabase-py APIError"""
+    if isinstance(error, APIError) and isinstance(error.code, str) and error.code:
+        return error.code
+    return None
+
+
+def _retryable(error: Exception) -> bool:
+    """True for throttling, server, connection and timeout errors"""
+    code = _postgrest_code(error)
+    if code is not None:
+        return code[:2] in RETRY_SQLSTATE_CLASSES
+    return (
+        isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError))
+        or _http_status(error) in RETRY_STATUSES
+        # APIError without any code: the response could not be read
+        or (isinstance(error, APIError) and not error.code)
+    )
+
+
+def _row_error(error: Exception) -> bool:
+    """True when the server rejected the rows themselves (bad data, too large)"""
+    code = _postgrest_code(error)
+    if code is not None:
+        # PGRST3xx are auth errors: every row would fail the same way
+        return code[:2] in ROW_ERROR_SQLSTATE_CLASSES or (
+            code.startswith("PGRST") and not code.startswith("PGRST3")
+        )
+    return _http_status(error) in ROW_ERROR_STATUSES
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retry `attempt`: Retry-After if given, else jittered backoff"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 30) + random.random()
+
+
+def metadata_rows(documents: List[str], metadatas: List[Dict]) -> Iterator[Dict]:
+    """Yield the record columns other than the embedding, one dict per document"""
+    for i, (doc, meta) in enumerate(zip(documents, metadatas)):
+        yield {
+            "title": meta.get("title", "Unknown"),
+            "ref": meta.get("ref", f"doc_{i}"),
+            "chunk_id": meta.get("chunk_id", f"chunk_{i}"),
+            "hebrew": meta.get("hebrew", ""),
+            "english": meta.get("english", ""),
+            "combined": doc,
+            "chunk_index": meta.get("chunk_index", 0),
+            "total_chunks": meta.get("total_chunks", 1),
+        }
+
+
+def write_metadata_parquet(documents: List[str], metadatas: List[Dict], parquet_path: str):
+    """Write the metadata rows to a zstd-compressed Parquet file (needs pyarrow)"""
+    table = pa.Table.from_pylist(list(metadata_rows(documents, metadatas)), schema=METADATA_SCHEMA)
+    tmp_path = f"{parquet_path}.{os.getpid()}.tmp"  # Parallel uploaders may convert at once
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, parquet_path)
+
+
+def iter_parquet_rows(parquet_path: str, batch_size: int = BATCH_SIZE) -> Iterator[Dict]:
+    """Yield metadata rows from Parquet, batch_size rows in memory at a time"""
+    for batch in pq.ParquetFile(parquet_path).iter_batches(batch_size=batch_size):
+        yield from batch.to_pylist()
 
 
 def load_faiss_metadata(collection_name: str = "breslov_chunked") -> tuple:
-    """Load FAISS index and metadata"""
+    """
+    Load FAISS index and metadata rows (vectors are read later, see iter_embeddings)
+
+    With pyarrow installed, the pickled metadata is converted once to
+    <collection>_metadata.parquet (again whenever the pickle is newer), and
+    rows are then streamed from it instead of unpickled.
+
+    Returns:
+        (rows iterator, number of rows, index)
+    """
     import faiss
-    import numpy as np
 
     index_path = os.path.join(FAISS_DB_PATH, f"{collection_name}.index")
     metadata_path = os.path.join(FAISS_DB_PATH, f"{collection_name}_metadata.pkl")
+    parquet_path = os.path.join(FAISS_DB_PATH, f"{collection_name}_metadata.parquet")
 
     if not os.path.exists(index_path):
         raise FileNotFoundError(f"FAISS index not found: {index_path}")
 
-    # Load index
-    index = faiss.read_index(index_path)
+    # Memory-map the index: vectors are paged in as iter_embeddings walks
+    # them instead of the whole file being read into RAM up front
+    try:
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # Older FAISS builds cannot mmap flat indexes
+        index = faiss.read_index(index_path)
     print(f"Loaded FAISS index with {index.ntotal} vectors")
 
+    parquet_fresh = os.path.exists(parquet_path) and (
+        not os.path.exists(metadata_path)
+        or os.path.getmtime(parquet_path) >= os.path.getmtime(metadata_path)
+    )
+    if PYARROW_AVAILABLE and parquet_fresh:
+        n_rows = pq.ParquetFile(parquet_path).metadata.num_rows
+        print(f"Reading {n_rows} metadata rows from {parquet_path}")
+        return iter_parquet_rows(parquet_path), n_rows, index
+
     # Load metadata
     with open(metadata_path, 'rb') as f:
         metadata = pickle.load(f)
@@ -52,64 +226,251 @@ def load_faiss_metadata(collection_name: str = "breslov_chunked") -> tuple:
 
     print(f"Loaded {len(documents)} documents and {len(metadatas)} metadata entries")
 
-    # Extract embeddings from FAISS
-    embeddings = []
-    for i in range(index.ntotal):
-        vec = index.reconstruct(i)
-        embeddings.append(vec.tolist())
-
-    return documents, metadatas, embeddings
-
-
-def prepare_records(documents: List[str], metadatas: List[Dict], embeddings: List[List[float]]) -> List[Dict]:
-    """Prepare records for Supabase insert"""
-    records = []
+    if PYARROW_AVAILABLE:
+        try:
+            write_metadata_parquet(documents, metadatas, parquet_path)
+            print(f"Saved metadata to {parquet_path}")
+        except (pa.ArrowException, OSError) as e:
+            print(f"Could not save Parquet metadata: {e}")
 
-    for i, (doc, meta, emb) in enumerate(zip(documents, metadatas, embeddings)):
-        record = {
-            "title": meta.get("title", "Unknown"),
-            "ref": meta.get("ref", f"doc_{i}"),
-            "chunk_id": meta.get("chunk_id", f"chunk_{i}"),
-            "hebrew": meta.get("hebrew", ""),
-            "english": meta.get("english", ""),
-            "combined": doc,
-            "embedding": emb,
-            "chunk_index": meta.get("chunk_index", 0),
-            "total_chunks": meta.get("total_chunks", 1),
-        }
-        records.append(record)
+    return metadata_rows(documents, metadatas), min(len(documents), len(metadatas)), index
 
-    return records
 
+def iter_embeddings(
+    index,
+    batch_size: int = BATCH_SIZE,
+    start: int = 0,
+    stop: Optional[int] = None
+) -> Iterator[np.ndarray]:
+    """Yield the index vectors start..stop one at a time, reconstructed batch_size rows per call"""
+    import faiss
 
-def upload_to_supabase(records: List[Dict], supabase: Client):
-    """Upload records to Supabase in batches"""
-    total = len(records)
+    # IVF indexes: reconstruct_n scans every inverted list on each call, so
+    # build the id -> list map once and look the ids up with reconstruct_batch
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+
+    stop = index.ntotal if stop is None else min(stop, index.ntotal)
+    for begin in range(start, stop, batch_size):
+        end = min(begin + batch_size, stop)
+        if ivf is not None:
+            yield from index.reconstruct_batch(np.arange(begin, end, dtype=np.int64))
+        else:
+            yield from index.reconstruct_n(begin, end - begin)
+
+
+def prepare_records(rows: Iterable[Dict], embeddings: Iterable[np.ndarray]) -> Iterator[Dict]:
+    """Yield records for Supabase insert (embedding rows become lists here)"""
+    for row, emb in zip(rows, embeddings):
+        row["embedding"] = emb if ORJSON_AVAILABLE else emb.tolist()
+        yield row
+
+
+def _rest_session(pool_size: int = UPLOAD_WORKERS) -> requests.Session:
+    """HTTP session for posting batches straight to the PostgREST endpoint"""
+    session = requests.Session()
+    session.headers.update({
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Content-Type": "application/json",
+        "Prefer": "resolution=merge-duplicates,return=minimal",
+    })
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def upload_to_supabase(
+    records: Iterable[Dict],
+    supabase: Client,
+    total: int,
+    batch_size: int = BATCH_SIZE,
+    workers: int = UPLOAD_WORKERS
+):
+    """Upload records to Supabase in concurrent batches, consuming them as they are made"""
     uploaded = 0
     errors = 0
+    records = iter(records)
 
     print(f"\nUploading {total} records to Supabase...")
 
-    for i in range(0, total, BATCH_SIZE):
-        batch = records[i:i + BATCH_SIZE]
-        try:
-            result = supabase.table(TABLE_NAME).upsert(
+    if ORJSON_AVAILABLE:
+        # Serialize the batch (embeddings as float32 arrays) in one orjson call
+        # and post it directly, skipping supabase-py's per-row JSON encoding
+        session = _rest_session(workers)
+        url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{TABLE_NAME}"
+
+        def send(batch: List[Dict]):
+            response = session.post(
+                url,
+                params={"on_conflict": "chunk_id"},  # Update if chunk_id already exists
+                data=orjson.dumps(batch, option=orjson.OPT_SERIALIZE_NUMPY),
+                timeout=UPLOAD_TIMEOUT
+            )
+            response.raise_for_status()
+    else:
+        def send(batch: List[Dict]):
+            supabase.table(TABLE_NAME).upsert(
                 batch,
                 on_conflict="chunk_id"  # Update if chunk_id already exists
             ).execute()
 
-            uploaded += len(batch)
+    def upsert(batch: List[Dict]) -> int:
+        """Upsert a batch, returning the number of rows that were skipped"""
+        for attempt in range(UPLOAD_MAX_RETRIES):
+            try:
+                send(batch)
+                return 0
+            except Exception as e:
+                error = e
+                if attempt == UPLOAD_MAX_RETRIES - 1 or not _retryable(e):
+                    break
+                time.sleep(_retry_delay(e, attempt))
+
+        if not _row_error(error):
+            raise error
+
+        if len(batch) > 1:
+            # Body too large or a bad row: send each half separately, so
+            # only the offending rows are skipped
+            mid = len(batch) // 2
+            return upsert(batch[:mid]) + upsert(batch[mid:])
+
+        print(f"Skipping chunk {batch[0].get('chunk_id')}: {error}")
+        return 1
+
+    def finish(i: int, size: int, future):
+        nonlocal uploaded, errors
+        try:
+            skipped = future.result()
+
+            uploaded += size - skipped
+            errors += skipped
             progress = (uploaded / total) * 100
             print(f"Progress: {uploaded}/{total} ({progress:.1f}%)")
 
         except Exception as e:
-            errors += len(batch)
-            print(f"Error uploading batch {i}-{i+len(batch)}: {e}")
+            errors += size
+            print(f"Error uploading batch {i}-{i+size}: {e}")
+
+    # At most 2 * workers batches are held in memory at a time
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        i = 0
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            in_flight.append((i, len(batch), executor.submit(upsert, batch)))
+            i += len(batch)
+            if len(in_flight) >= 2 * workers:
+                finish(*in_flight.popleft())
+
+        while in_flight:
+            finish(*in_flight.popleft())
 
     return uploaded, errors
 
 
+def _vector_literal(embedding) -> str:
+    """pgvector text input ('[x,y,...]') for an embedding row"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(embedding, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(embedding)
+
+
+def copy_to_postgres(records: Iterable[Dict], db_url: str, total: int):
+    """
+    Bulk load records with COPY over a direct Postgres connection.
+
+    Rows are copied into a temporary staging table, then upserted on
+    chunk_id in one statement, all in one transaction.
+    """
+    import psycopg
+
+    columns = ", ".join(COPY_COLUMNS)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in COPY_COLUMNS if c != "chunk_id")
+    copied = 0
+
+    print(f"\nCopying {total} records to Postgres...")
+
+    with psycopg.connect(db_url) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"CREATE TEMP TABLE staging ON COMMIT DROP AS "
+                f"SELECT {columns} FROM {TABLE_NAME} WITH NO DATA"
+            )
+            with cur.copy(f"COPY staging ({columns}) FROM STDIN") as copy:
+                for record in records:
+                    copy.write_row(tuple(
+                        _vector_literal(record[c]) if c == "embedding" else record[c]
+                        for c in COPY_COLUMNS
+                    ))
+                    copied += 1
+                    if copied % (BATCH_SIZE * 10) == 0:
+                        print(f"Progress: {copied}/{total} ({copied / total * 100:.1f}%)")
+
+            cur.execute(
+                f"INSERT INTO {TABLE_NAME} ({columns}) SELECT {columns} FROM staging "
+                f"ON CONFLICT (chunk_id) DO UPDATE SET {updates}"
+            )
+
+    return copied, 0
+
+
 def main():
+    parser = argparse.ArgumentParser(
+        description="Upload FAISS embeddings to Supabase"
+    )
+    parser.add_argument(
+        "-y", "--yes",
+        action="store_true",
+        help="Upload without asking for confirmation"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("pgrest", "copy"),
+        default=UPLOAD_MODE,
+        help="PostgREST upserts or COPY over psycopg (default: UPLOAD_MODE or pgrest)"
+    )
+    parser.add_argument(
+        "--collection",
+        default="breslov_chunked",
+        help="FAISS collection to upload"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="Rows per upsert request"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=UPLOAD_WORKERS,
+        help="Upsert requests in flight at once"
+    )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        default=0,
+        help="Slice of the index to upload (0 .. num-shards - 1)"
+    )
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=1,
+        help="Number of slices the index is split into"
+    )
+
+    args = parser.parse_args()
+    if args.batch_size < 1 or args.concurrency < 1:
+        parser.error("--batch-size and --concurrency must be positive")
+    if not 0 <= args.shard < args.num_shards:
+        parser.error("--shard must be between 0 and --num-shards - 1")
+
     print("=" * 60)
     print("GUEZI RAG - Upload to Supabase")
     print("=" * 60)
@@ -120,8 +481,15 @@ def main():
         print("Required: SUPABASE_URL, SUPABASE_SERVICE_KEY")
         sys.exit(1)
 
+    if args.mode == "copy" and not SUPABASE_DB_URL:
+        print("ERROR: copy mode requires SUPABASE_DB_URL in config/.env")
+        sys.exit(1)
+
     print(f"\nSupabase URL: {SUPABASE_URL}")
     print(f"Table: {TABLE_NAME}")
+    print(f"Mode: {args.mode}")
+    if args.num_shards > 1:
+        print(f"Shard: {args.shard + 1}/{args.num_shards}")
 
     # Initialize Supabase client
     try:
@@ -134,19 +502,28 @@ def main():
     # Load FAISS data
     print("\nLoading FAISS data...")
     try:
-        documents, metadatas, embeddings = load_faiss_metadata("breslov_chunked")
+        rows, n_rows, index = load_faiss_metadata(args.collection)
     except Exception as e:
         print(f"ERROR: Failed to load FAISS data: {e}")
         sys.exit(1)
 
-    # Prepare records
-    print("\nPreparing records...")
-    records = prepare_records(documents, metadatas, embeddings)
-    print(f"Prepared {len(records)} records")
+    # This shard's contiguous slice of the index
+    n_records = min(n_rows, index.ntotal)
+    start = n_records * args.shard // args.num_shards
+    stop = n_records * (args.shard + 1) // args.num_shards
+
+    # Records are built while uploading, one batch of vectors at a time
+    total = stop - start
+    records = prepare_records(
+        islice(rows, start, stop),
+        iter_embeddings(index, args.batch_size, start, stop)
+    )
+    print(f"\n{total} records to upload (rows {start}-{stop})")
 
     # Check first record
-    if records:
-        sample = records[0]
+    sample = next(records, None)
+    if sample is not None:
+        records = chain([sample], records)
         print(f"\nSample record:")
         print(f"  Title: {sample['title']}")
         print(f"  Ref: {sample['ref']}")
@@ -154,13 +531,24 @@ def main():
         print(f"  Embedding dimensions: {len(sample['embedding'])}")
 
     # Confirm upload
-    response = input(f"\nUpload {len(records)} records to Supabase? (y/n): ")
-    if response.lower() != 'y':
-        print("Upload cancelled.")
-        sys.exit(0)
+    if not args.yes:
+        response = input(f"\nUpload {total} records to Supabase? (y/n): ")
+        if response.lower() != 'y':
+            print("Upload cancelled.")
+            sys.exit(0)
 
     # Upload
-    uploaded, errors = upload_to_supabase(records, supabase)
+    if args.mode == "copy":
+        try:
+            uploaded, errors = copy_to_postgres(records, SUPABASE_DB_URL, total)
+        except Exception as e:
+            # The transaction was rolled back: nothing was written
+            print(f"Error copying records: {e}")
+            uploaded, errors = 0, total
+    else:
+        uploaded, errors = upload_to_supabase(
+            records, supabase, total, args.batch_size, args.concurrency
+        )
 
     print("\n" + "=" * 60)
     print("Upload Complete!")
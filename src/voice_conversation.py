@@ -6,7 +6,7 @@ Supports barge-in (interruption) for natural conversation flow
 
 import os
 import asyncio
-import base64
+import struct
 from typing import Optional, Callable, AsyncGenerator
 from dotenv import load_dotenv
 
@@ -72,6 +72,7 @@ class VoiceConversation:
         # State
         self.is_connected = False
         self.session = None
+        self._session_context = None
 
     def _get_config(self):
         """Get Live API configuration"""
@@ -108,10 +109,14 @@ class VoiceConversation:
     async def connect(self):
         """Connect to Gemini Live API"""
         try:
-            self.session = await self.client.aio.live.connect(
+            # live.connect() is an async context manager: entered here,
+            # exited in disconnect()
+            context = self.client.aio.live.connect(
                 model=self.MODEL,
                 config=self._get_config()
             )
+            self.session = await context.__aenter__()
+            self._session_context = context
             self.is_connected = True
             return True
         except Exception as e:
@@ -120,20 +125,30 @@ class VoiceConversation:
 
     async def disconnect(self):
         """Disconnect from the API"""
-        if self.session:
+        if self._session_context:
             try:
-                await self.session.close()
+                await self._session_context.__aexit__(None, None, None)
             except:
                 pass
         self.is_connected = False
         self.session = None
+        self._session_context = None
+
+    async def __aenter__(self):
+        if not await self.connect():
+            raise ConnectionError("Could not connect to Gemini Live API")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
 
     async def send_audio(self, audio_data: bytes):
         """
         Send audio data to the API.
 
         Args:
-            audio_data: Raw 16-bit PCM audio at 16kHz, mono
+            audio_data: Raw little-endian 16-bit PCM bytes at 16kHz, mono
+                (not base64; the bytes are sent as-is)
         """
         if not self.session:
             return
@@ -157,7 +172,7 @@ class VoiceConversation:
             - type: 'transcription' | 'audio' | 'interrupted'
             - role: 'user' | 'assistant' (for transcription)
             - text: transcription text
-            - audio: audio bytes (for audio type)
+            - audio: raw 16-bit PCM bytes at 24kHz (for audio type)
         """
         if not self.session:
             return
@@ -226,34 +241,23 @@ class VoiceConversation:
             print(f"Send text error: {e}")
 
 
+# RIFF/WAVE header for 16-bit PCM, packed in one call
+_WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+
 def pcm_to_wav(pcm_data: bytes, sample_rate: int = 24000) -> bytes:
     """Convert raw PCM to WAV format"""
-    import struct
-    import io
-
     channels = 1
     bits_per_sample = 16
     byte_rate = sample_rate * channels * bits_per_sample // 8
     block_align = channels * bits_per_sample // 8
     data_size = len(pcm_data)
 
-    wav_buffer = io.BytesIO()
-    wav_buffer.write(b'RIFF')
-    wav_buffer.write(struct.pack('<I', 36 + data_size))
-    wav_buffer.write(b'WAVE')
-    wav_buffer.write(b'fmt ')
-    wav_buffer.write(struct.pack('<I', 16))
-    wav_buffer.write(struct.pack('<H', 1))
-    wav_buffer.write(struct.pack('<H', channels))
-    wav_buffer.write(struct.pack('<I', sample_rate))
-    wav_buffer.write(struct.pack('<I', byte_rate))
-    wav_buffer.write(struct.pack('<H', block_align))
-    wav_buffer.write(struct.pack('<H', bits_per_sample))
-    wav_buffer.write(b'data')
-    wav_buffer.write(struct.pack('<I', data_size))
-    wav_buffer.write(pcm_data)
-
-    return wav_buffer.getvalue()
+    return _WAV_HEADER.pack(
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, byte_rate, block_align, bits_per_sample,
+        b'data', data_size
+    ) + pcm_data
 
 
 # Simple test